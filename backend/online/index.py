@@ -1,130 +1,763 @@
 '''
 Business: Online users management with long polling
-Args: GET to fetch online list, POST to update heartbeat
-Returns: List of online users (auto-cleanup old connections)
+Args: GET to fetch online list, POST with X-Auth-Token to update heartbeat
+Returns: List of online users (expired entries are swept in the background)
 '''
 
+import base64
+import hashlib
+import hmac
 import json
 import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from typing import Dict, Any, Callable, List, Optional, Tuple
 
-def get_db_connection():
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn)
+# Optional; responses fall back to the stdlib encoder. It pulls in datetime, uuid and
+# zoneinfo, so it is imported by the first response that encodes anything
+orjson: Any = None  # None until tried, False when it is not installed
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+# Built once and shared by every response. Nothing mutates them in place:
+# finish_request_timer copies the headers before adding Server-Timing
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+    'Access-Control-Max-Age': '86400'
+}
+METRICS_HEADERS = {'Content-Type': 'text/plain; version=0.0.4', 'Cache-Control': 'no-store'}
+ERROR_BODIES = {error: json.dumps({'error': error}) for error in (
+    'Forbidden', 'Missing token', 'Invalid token', 'Method not allowed',
+)}
+ONLINE_BODY = json.dumps({'status': 'online'})
+
+
+# shared:begin responses, copied from backend/_shared/responses.py.in by scripts/sync_shared.py
+# Relies on imports: json, typing Any/Dict
+# Relies on the function for: JSON_HEADERS, ERROR_BODIES
+def load_orjson() -> None:
+    global orjson
+    try:
+        import orjson
+    except ImportError:
+        orjson = False
+
+
+def dump_json(value: Any) -> str:
+    if orjson is None:
+        load_orjson()
+    if orjson:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value)
+
+
+def json_response(status: int, body: str) -> Dict[str, Any]:
+    return {'statusCode': status, 'headers': JSON_HEADERS, 'body': body}
+
+
+def error_response(status: int, error: str) -> Dict[str, Any]:
+    return json_response(status, ERROR_BODIES.get(error) or json.dumps({'error': error}))
+# shared:end responses
+
+
+# psycopg2 adds ~20 ms to a cold start, so it is imported on the first connect instead:
+# preflights, cached presence and rejected heartbeats are answered without it
+psycopg2: Any = None
+TRANSACTION_STATUS_IDLE: Any = None
+execute_values: Any = None
+TimedDictCursor: Any = None
+driver_lock = threading.Lock()
+
+
+def load_driver() -> None:
+    global psycopg2, TRANSACTION_STATUS_IDLE, execute_values, TimedDictCursor
+    if psycopg2 is not None:
+        return
+    with driver_lock:
+        if psycopg2 is None:
+            from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+            from psycopg2.extras import RealDictCursor, execute_values
+            TimedDictCursor = make_timed_cursor(RealDictCursor)
+            # Bound last: once psycopg2 is set, everything above is too
+            import psycopg2
+
+
+# shared:begin pool, copied from backend/_shared/pool.py.in by scripts/sync_shared.py
+# Relies on imports: os, threading, time, typing Any/Callable/Dict/List/Tuple
+# Relies on the function for: psycopg2 and TRANSACTION_STATUS_IDLE, as load_driver binds them
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_ACQUIRE_TIMEOUT = 5.0
+DB_CONN_MAX_AGE = 300  # recycle connections older than 5 minutes
+DB_CONN_VALIDATE_AFTER = 30  # ping connections that sat idle longer than this
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+    '''Process-wide pool of PostgreSQL connections kept alive between warm invocations'''
+
+    def __init__(self, max_size: int, connect: Callable[[], Any]):
+        self.max_size = max_size
+        self._connect = connect
+        self._idle: List[Tuple[Any, float, float]] = []  # (conn, opened_at, released_at)
+        self._opened_at: Dict[int, float] = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self.stats = {'hits': 0, 'misses': 0, 'reconnects': 0, 'recycled': 0, 'discarded': 0}
+
+    def _open(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self._opened_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _drop(self, conn) -> None:
+        self._opened_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _ping(conn) -> bool:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire(self):
+        deadline = time.monotonic() + DB_POOL_ACQUIRE_TIMEOUT
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhausted('Connection pool exhausted')
+                self._cond.wait(remaining)
+            if not self._idle:
+                self._size += 1
+                self.stats['misses'] += 1
+                idle = None
+            else:
+                idle = self._idle.pop()
+        if idle is None:
+            return self._open()
+        
+        conn, opened_at, released_at = idle
+        now = time.monotonic()
+        if now - opened_at > DB_CONN_MAX_AGE:
+            self._drop(conn)
+            self.stats['recycled'] += 1
+            return self._open()
+        if conn.closed or (now - released_at > DB_CONN_VALIDATE_AFTER and not self._ping(conn)):
+            self._drop(conn)
+            self.stats['reconnects'] += 1
+            return self._open()
+        self.stats['hits'] += 1
+        return conn
+
+    def release(self, conn, discard: bool = False) -> None:
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        
+        if discard or conn.closed:
+            self._drop(conn)
+            with self._cond:
+                self._size -= 1
+                self.stats['discarded'] += 1
+                self._cond.notify()
+            return
+        
+        with self._cond:
+            self._idle.append((conn, self._opened_at.get(id(conn), 0.0), time.monotonic()))
+            self._cond.notify()
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._cond:
+            return dict(self.stats, size=self._size, idle=len(self._idle))
+# shared:end pool
+
+
+def open_connection():
+    load_driver()
+    return psycopg2.connect(os.environ.get('DATABASE_URL'))
+
+
+db_pool = ConnectionPool(DB_POOL_MAX_SIZE, open_connection)
+
+
+def get_pool_stats() -> Dict[str, int]:
+    return db_pool.snapshot()
+
+
+ONLINE_TTL = 30  # users without a heartbeat for this long are offline
+SWEEP_INTERVAL = 60  # delete expired rows at most once a minute per instance
+SWEEP_LOCK_ID = 7340401  # advisory lock so concurrent instances do not sweep together
+
+sweep_lock = threading.Lock()
+last_sweep = 0.0
+
+
+def sweep_expired_users() -> None:
+    conn = None
+    broken = False
+    try:
+        # Inside the try: a failed connect must still free sweep_lock for the next attempt
+        conn = db_pool.acquire()
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', (SWEEP_LOCK_ID,))
+            if cursor.fetchone()[0]:
+                cursor.execute(
+                    "DELETE FROM online_users WHERE last_seen < %s",
+                    (datetime.now() - timedelta(seconds=ONLINE_TTL),)
+                )
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+    except (psycopg2.Error, PoolExhausted):
+        pass
+    finally:
+        if conn is not None:
+            db_pool.release(conn, discard=broken)
+        sweep_lock.release()
+
+
+def maybe_start_sweep() -> None:
+    global last_sweep
+    now = time.monotonic()
+    if now - last_sweep < SWEEP_INTERVAL or not sweep_lock.acquire(blocking=False):
+        return
+    last_sweep = now
+    try:
+        threading.Thread(target=sweep_expired_users, name='online-sweeper', daemon=True).start()
+    except RuntimeError:
+        sweep_lock.release()
+
+
+PRESENCE_CACHE_TTL = 2.0  # seconds a serialized online list is served without a query
+
+presence_lock = threading.Lock()
+presence_snapshot: Optional[Tuple[float, Dict[str, str], str]] = None  # (expires_at, headers, body)
+
+
+def get_cached_presence() -> Optional[Tuple[Dict[str, str], str]]:
+    snapshot = presence_snapshot
+    if snapshot is None or snapshot[0] < time.monotonic():
+        return None
+    return snapshot[1], snapshot[2]
+
+
+def store_presence(body: str) -> Tuple[Dict[str, str], str]:
+    global presence_snapshot
+    # Content hash, so every instance hands out the same ETag for the same list
+    etag = '"' + hashlib.blake2b(body.encode('utf-8'), digest_size=12).hexdigest() + '"'
+    # Cached hits reuse these headers instead of building them per request
+    response_headers = dict(JSON_HEADERS, **{
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'no-cache',
+        'ETag': etag
+    })
+    with presence_lock:
+        presence_snapshot = (time.monotonic() + PRESENCE_CACHE_TTL, response_headers, body)
+    return response_headers, body
+
+
+def invalidate_presence() -> None:
+    global presence_snapshot
+    with presence_lock:
+        presence_snapshot = None
+
+
+def presence_response(event: Dict[str, Any], response_headers: Dict[str, str], body: str) -> Dict[str, Any]:
+    headers = event.get('headers', {}) or {}
+    if_none_match = headers.get('If-None-Match') or headers.get('if-none-match')
+    etag = response_headers['ETag']
+    
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return {'statusCode': 304, 'headers': response_headers, 'body': ''}
+    
+    return {'statusCode': 200, 'headers': response_headers, 'body': body}
+
+
+HEARTBEAT_CLIENT_INTERVAL = 10  # Lobby.tsx sends a heartbeat this often
+HEARTBEAT_CLIENT_SLACK = 5  # how late a heartbeat may arrive: browser timers drift and requests queue
+# A heartbeat is written once the stored last_seen is this old, because it could expire before a
+# late next heartbeat. Younger ones are absorbed: with a 30 s TTL that is every other heartbeat
+HEARTBEAT_WRITE_INTERVAL = ONLINE_TTL - HEARTBEAT_CLIENT_INTERVAL - HEARTBEAT_CLIENT_SLACK
+HEARTBEAT_FLUSH_INTERVAL = 5  # batch absorbed heartbeats into one UPDATE at most this often
+
+heartbeat_lock = threading.Lock()
+heartbeat_written: Dict[str, float] = {}  # user_id -> when last_seen was last written
+heartbeat_pending: Dict[str, float] = {}  # user_id -> latest heartbeat not yet written
+last_heartbeat_flush = 0.0
+
+
+def absorb_heartbeat(user_id: str) -> bool:
+    now = time.monotonic()
+    with heartbeat_lock:
+        written = heartbeat_written.get(user_id)
+        if written is None or now - written >= HEARTBEAT_WRITE_INTERVAL:
+            # This request writes it, so an older pending one must not be flushed after it
+            heartbeat_pending.pop(user_id, None)
+            return False
+        heartbeat_pending[user_id] = now
+        return True
+
+
+def mark_heartbeat_written(user_id: str) -> None:
+    with heartbeat_lock:
+        heartbeat_written[user_id] = time.monotonic()
+        heartbeat_pending.pop(user_id, None)
+
+
+def take_due_heartbeats() -> List[Tuple[str, float]]:
+    global last_heartbeat_flush
+    now = time.monotonic()
+    with heartbeat_lock:
+        if not heartbeat_pending or now - last_heartbeat_flush < HEARTBEAT_FLUSH_INTERVAL:
+            return []
+        last_heartbeat_flush = now
+        
+        # A client that keeps sending gets written by its next heartbeat. An absorbed heartbeat is
+        # flushed once that next one is overdue and the stored last_seen could expire before the next flush
+        due_after = ONLINE_TTL - 2 * HEARTBEAT_FLUSH_INTERVAL
+        due = [
+            (user_id, now - seen)
+            for user_id, seen in heartbeat_pending.items()
+            if now - heartbeat_written.get(user_id, 0.0) >= due_after and now - seen >= HEARTBEAT_CLIENT_INTERVAL
+        ]
+        for user_id, age in due:
+            del heartbeat_pending[user_id]
+            # The row gets the heartbeat's own time, not the flush time
+            heartbeat_written[user_id] = now - age
+        
+        for user_id, written in list(heartbeat_written.items()):
+            if now - written > ONLINE_TTL and user_id not in heartbeat_pending:
+                del heartbeat_written[user_id]
+    return due
+
+
+def flush_heartbeats(conn, cursor, due: List[Tuple[str, float]]) -> None:
+    rows = execute_values(
+        cursor,
+        """
+        UPDATE online_users AS o
+        SET last_seen = GREATEST(o.last_seen, CURRENT_TIMESTAMP - v.age * INTERVAL '1 second')
+        FROM (VALUES %s) AS v(user_id, age)
+        WHERE o.user_id = v.user_id
+        RETURNING o.user_id
+        """,
+        due,
+        template='(%s, %s::float8)',
+        fetch=True
+    )
+    conn.commit()
+    
+    # Rows swept while we were coalescing must be re-inserted by the next full heartbeat
+    updated = {row['user_id'] for row in rows}
+    with heartbeat_lock:
+        for user_id, _ in due:
+            if user_id not in updated:
+                heartbeat_written.pop(user_id, None)
+
+
+# shared:begin metrics, copied from backend/_shared/metrics.py.in by scripts/sync_shared.py
+# Relies on imports: hmac, os, random, threading, time, bisect_left, typing Any/Dict/List/Tuple
+# Relies on the function for: METRICS_HEADERS, error_response (responses block), metrics = Metrics('<function>'), metrics_gauges()
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.05'))  # share of requests timed phase by phase
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # GET ?action=metrics needs a matching X-Metrics-Token; unset, there is no metrics endpoint
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+
+class RequestTimer:
+    '''Phase timings and row count of one sampled request'''
+    
+    sampled = True
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self.rows = 0
+    
+    def phase(self, name: str) -> 'TimedPhase':
+        return TimedPhase(self, name)
+    
+    def add(self, name: str, duration: float, rows: int = 0) -> None:
+        self.phases.append((name, duration))
+        self.rows += rows
+
+
+class TimedPhase:
+    __slots__ = ('timer', 'name', 'started')
+    
+    def __init__(self, timer: RequestTimer, name: str):
+        self.timer = timer
+        self.name = name
+        self.started = 0.0
+    
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+    
+    def __exit__(self, *exc_info) -> None:
+        self.timer.add(self.name, time.perf_counter() - self.started)
+
+
+class NoopTimer:
+    '''Stands in for RequestTimer on requests that are not sampled, so timing calls cost next to nothing'''
+    
+    sampled = False
+    
+    def phase(self, name: str) -> 'NoopTimer':
+        return self
+    
+    def add(self, name: str, duration: float, rows: int = 0) -> None:
+        pass
+    
+    def __enter__(self) -> None:
+        pass
+    
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+NOOP_TIMER = NoopTimer()
+timer_local = threading.local()
+
+
+def current_timer():
+    return getattr(timer_local, 'timer', NOOP_TIMER)
+
+
+class Metrics:
+    '''Process-wide request counters and sampled phase histograms, rendered in Prometheus text format'''
+    
+    def __init__(self, function: str):
+        self.function = function
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, int], int] = {}
+        self.phases: Dict[Tuple[str, str], List[float]] = {}  # bucket counts, then count and sum
+        self.rows: Dict[str, int] = {}
+        self.response_bytes: Dict[str, int] = {}
+    
+    def _observe(self, route: str, phase: str, duration: float) -> None:
+        histogram = self.phases.get((route, phase))
+        if histogram is None:
+            histogram = [0] * (len(METRICS_BUCKETS) + 3)
+            self.phases[(route, phase)] = histogram
+        histogram[bisect_left(METRICS_BUCKETS, duration)] += 1
+        histogram[-2] += 1
+        histogram[-1] += duration
+    
+    def observe(self, route: str, phase: str, duration: float) -> None:
+        with self._lock:
+            self._observe(route, phase, duration)
+    
+    def record(self, route: str, status: int, timer, total: float, body_bytes: int) -> None:
+        with self._lock:
+            self.requests[(route, status)] = self.requests.get((route, status), 0) + 1
+            if not timer.sampled:
+                return
+            self._observe(route, 'total', total)
+            for phase, duration in timer.phases:
+                self._observe(route, phase, duration)
+            self.rows[route] = self.rows.get(route, 0) + timer.rows
+            self.response_bytes[route] = self.response_bytes.get(route, 0) + body_bytes
+    
+    def render(self, gauges: Dict[str, float]) -> str:
+        fn = self.function
+        lines = ['# TYPE handler_requests_total counter']
+        with self._lock:
+            for (route, status), count in sorted(self.requests.items()):
+                lines.append(f'handler_requests_total{{function="{fn}",route="{route}",status="{status}"}} {count}')
+            lines.append('# TYPE handler_phase_seconds histogram')
+            for (route, phase), histogram in sorted(self.phases.items()):
+                labels = f'function="{fn}",route="{route}",phase="{phase}"'
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS, histogram):
+                    cumulative += count
+                    lines.append(f'handler_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'handler_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram[-2]}')
+                lines.append(f'handler_phase_seconds_count{{{labels}}} {histogram[-2]}')
+                lines.append(f'handler_phase_seconds_sum{{{labels}}} {histogram[-1]:.6f}')
+            lines.append('# TYPE handler_sampled_rows_total counter')
+            for route, rows in sorted(self.rows.items()):
+                lines.append(f'handler_sampled_rows_total{{function="{fn}",route="{route}"}} {rows}')
+            lines.append('# TYPE handler_sampled_response_bytes_total counter')
+            for route, size in sorted(self.response_bytes.items()):
+                lines.append(f'handler_sampled_response_bytes_total{{function="{fn}",route="{route}"}} {size}')
+        for name, value in gauges.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{{function="{fn}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def start_request_timer():
+    timer = RequestTimer() if random.random() < METRICS_SAMPLE_RATE else NOOP_TIMER
+    timer_local.timer = timer
+    return timer
+
+
+def finish_request_timer(timer, route: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    timer_local.timer = NOOP_TIMER
+    status = response.get('statusCode', 200)
+    if not timer.sampled:
+        metrics.record(route, status, timer, 0.0, 0)
+        return response
+    
+    total = time.perf_counter() - timer.started
+    metrics.record(route, status, timer, total, len((response.get('body') or '').encode('utf-8')))
+    server_timing = [f'{name};dur={duration * 1000:.2f}' for name, duration in timer.phases]
+    server_timing.append(f'total;dur={total * 1000:.2f}')
+    response['headers'] = dict(response.get('headers') or {}, **{
+        'Server-Timing': ', '.join(server_timing),
+        'Timing-Allow-Origin': '*'
+    })
+    return response
+
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    headers = event.get('headers', {}) or {}
+    supplied = headers.get('X-Metrics-Token') or headers.get('x-metrics-token') or ''
+    if not METRICS_TOKEN:
+        # Pool, cache and bus internals stay private unless a scraper is configured
+        return error_response(404, 'Not found')
+    if not hmac.compare_digest(supplied.encode('utf-8'), METRICS_TOKEN.encode('utf-8')):
+        return error_response(403, 'Forbidden')
+    return {
+        'statusCode': 200,
+        'headers': METRICS_HEADERS,
+        'body': metrics.render(metrics_gauges())
+    }
+# shared:end metrics
+
+
+metrics = Metrics('online')
+
+
+# shared:begin timed_cursor, copied from backend/_shared/timed_cursor.py.in by scripts/sync_shared.py
+# Relies on imports: time
+# Relies on the function for: current_timer (metrics block)
+def make_timed_cursor(base: type) -> type:
+    '''RealDictCursor subclass that reports every statement to the current request's timer'''
+    
+    class TimedDictCursor(base):
+        def execute(self, query, vars=None):
+            timer = current_timer()
+            if not timer.sampled:
+                return super().execute(query, vars)
+            started = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                timer.add('sql', time.perf_counter() - started, max(self.rowcount, 0))
+    
+    return TimedDictCursor
+# shared:end timed_cursor
+
+
+def route_label(event: Dict[str, Any]) -> str:
+    return event.get('httpMethod', 'GET')
+
+
+def metrics_gauges() -> Dict[str, float]:
+    return {f'db_pool_{name}': value for name, value in get_pool_stats().items()}
+
+
+PROFILE_CACHE_SIZE = 10000  # guest profiles never change, so entries only leave through LRU eviction
+
+profile_lock = threading.Lock()
+profile_cache: 'OrderedDict[str, Dict[str, str]]' = OrderedDict()
+
+
+def get_profiles(cursor, user_ids: List[str]) -> Dict[str, Dict[str, str]]:
+    '''{user_id: {user_id, nick, avatar_url, color}} from the in-process cache, loading misses in one query'''
+    profiles: Dict[str, Dict[str, str]] = {}
+    with profile_lock:
+        for user_id in user_ids:
+            profile = profile_cache.get(user_id)
+            if profile is not None:
+                profile_cache.move_to_end(user_id)
+                profiles[user_id] = profile
+    
+    missing = list({user_id for user_id in user_ids if user_id not in profiles})
+    if missing:
+        cursor.execute('SELECT user_id, nick, avatar_url, color FROM users WHERE user_id = ANY(%s)', (missing,))
+        rows = cursor.fetchall()
+        with profile_lock:
+            for row in rows:
+                profile = dict(row)
+                profile_cache[profile['user_id']] = profile
+                profiles[profile['user_id']] = profile
+            while len(profile_cache) > PROFILE_CACHE_SIZE:
+                profile_cache.popitem(last=False)
+    return profiles
+
+
+# shared:begin tokens, copied from backend/_shared/tokens.py.in by scripts/sync_shared.py
+# Relies on imports: base64, hashlib, hmac, json, os, threading, time, OrderedDict, typing Any/Dict/Optional
+TOKEN_SECRET = os.environ.get('TOKEN_SECRET', '')  # shared with auth, which signs the tokens
+TOKEN_CACHE_SIZE = 4096  # recently verified tokens kept to skip the HMAC on every poll
+
+token_cache_lock = threading.Lock()
+token_cache: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+
+
+def decode_token_segment(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def verify_token(token: Optional[str]) -> Optional[Dict[str, Any]]:
+    '''Claims ({user_id, nick, color, exp}) of an unexpired token signed by auth, else None'''
+    if not token or not TOKEN_SECRET:
+        return None
+    
+    with token_cache_lock:
+        claims = token_cache.get(token)
+        if claims is not None:
+            token_cache.move_to_end(token)
+    
+    if claims is None:
+        version, _, rest = token.partition('.')
+        payload, _, signature = rest.partition('.')
+        if version != 'v1' or not payload or not signature:
+            return None
+        expected = hmac.new(TOKEN_SECRET.encode('utf-8'), f'v1.{payload}'.encode('utf-8'), hashlib.sha256).digest()
+        try:
+            if not hmac.compare_digest(decode_token_segment(signature), expected):
+                return None
+            claims = json.loads(decode_token_segment(payload))
+        except ValueError:
+            return None
+        if not isinstance(claims, dict) or not isinstance(claims.get('exp'), int) or not claims.get('user_id'):
+            return None
+        with token_cache_lock:
+            token_cache[token] = claims
+            if len(token_cache) > TOKEN_CACHE_SIZE:
+                token_cache.popitem(last=False)
+    
+    if claims['exp'] <= time.time():
+        return None
+    return claims
+# shared:end tokens
+
+
+def handle_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    if method == 'GET':
+        cached = get_cached_presence()
+        if cached is not None:
+            return presence_response(event, *cached)
+    
+    elif method == 'POST':
+        headers = event.get('headers', {})
+        token = headers.get('X-Auth-Token') or headers.get('x-auth-token')
+        
+        if not token:
+            return error_response(401, 'Missing token')
+        
+        claims = verify_token(token)
+        if claims is None:
+            return error_response(401, 'Invalid token')
+        
+        # The heartbeat body is not needed: the token says who this is, users holds the profile
+        user_id = claims['user_id']
+        
+        # A fresh-enough user only needs an in-memory bump until the next batched flush
+        absorbed = absorb_heartbeat(user_id)
+        due = take_due_heartbeats()
+        if absorbed and not due:
+            return json_response(200, ONLINE_BODY)
+    
+    else:
+        return error_response(405, 'Method not allowed')
+    
+    timer = current_timer()
+    with timer.phase('db_acquire'):
+        conn = db_pool.acquire()
+    cursor = conn.cursor(cursor_factory=TimedDictCursor)
+    broken = False
     
     try:
         if method == 'GET':
-            cutoff_time = datetime.now() - timedelta(seconds=30)
-            
-            cursor.execute(
-                "DELETE FROM online_users WHERE last_seen < %s",
-                (cutoff_time,)
-            )
-            conn.commit()
+            cutoff_time = datetime.now() - timedelta(seconds=ONLINE_TTL)
             
-            cursor.execute(
-                "SELECT user_id, nick, avatar_url, color FROM online_users ORDER BY nick"
-            )
-            users = cursor.fetchall()
+            # Pure read: expired rows are filtered here and deleted by the sweeper
+            cursor.execute("SELECT user_id FROM online_users WHERE last_seen >= %s", (cutoff_time,))
+            user_ids = [row['user_id'] for row in cursor.fetchall()]
+            profiles = get_profiles(cursor, user_ids)
+            maybe_start_sweep()
             
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'users': [dict(u) for u in users]
-                }),
-                'isBase64Encoded': False
-            }
+            with timer.phase('encode'):
+                users = sorted(profiles.values(), key=lambda profile: profile['nick'].casefold())
+                body = dump_json({'users': users})
+            response_headers, body = store_presence(body)
+            return presence_response(event, response_headers, body)
         
-        elif method == 'POST':
-            headers = event.get('headers', {})
-            token = headers.get('X-Auth-Token') or headers.get('x-auth-token')
-            
-            if not token:
-                return {
-                    'statusCode': 401,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'Missing token'}),
-                    'isBase64Encoded': False
-                }
-            
-            body_data = json.loads(event.get('body', '{}'))
-            user_id = body_data.get('user_id')
-            nick = body_data.get('nick')
-            avatar_url = body_data.get('avatar_url')
-            color = body_data.get('color')
-            
-            if not all([user_id, nick, avatar_url, color]):
-                return {
-                    'statusCode': 400,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'Missing required fields'}),
-                    'isBase64Encoded': False
-                }
-            
+        if not absorbed:
             cursor.execute(
                 """
-                INSERT INTO online_users (user_id, nick, avatar_url, color, token, last_seen)
-                VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                INSERT INTO online_users (user_id, last_seen)
+                VALUES (%s, CURRENT_TIMESTAMP)
                 ON CONFLICT (user_id) 
                 DO UPDATE SET last_seen = CURRENT_TIMESTAMP
+                RETURNING (xmax = 0) AS inserted
                 """,
-                (user_id, nick, avatar_url, color, token)
+                (user_id,)
             )
+            inserted = cursor.fetchone()['inserted']
             conn.commit()
+            mark_heartbeat_written(user_id)
             
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'status': 'online'}),
-                'isBase64Encoded': False
-            }
+            # A user coming online changes the list; refreshed heartbeats do not
+            if inserted:
+                invalidate_presence()
         
-        else:
-            return {
-                'statusCode': 405,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
+        if due:
+            flush_heartbeats(conn, cursor, due)
+        
+        return json_response(200, ONLINE_BODY)
     
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
     finally:
         cursor.close()
-        conn.close()
+        with timer.phase('db_release'):
+            db_pool.release(conn, discard=broken)
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method = event.get('httpMethod')
+    # Preflights are answered before metrics, routing or anything that could need the database
+    if method == 'OPTIONS':
+        return {'statusCode': 200, 'headers': OPTIONS_HEADERS, 'body': ''}
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get('action') == 'metrics':
+        return metrics_response(event)
+    
+    route = route_label(event)
+    timer = start_request_timer()
+    try:
+        response = handle_request(event, context)
+    except Exception:
+        finish_request_timer(timer, route, {'statusCode': 500})
+        raise
+    return finish_request_timer(timer, route, response)
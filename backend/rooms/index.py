@@ -1,396 +1,1547 @@
+import base64
+import hashlib
+import hmac
 import json
+import logging
+import math
 import os
+import queue
+import re
 import time
 import random
 import string
-import urllib.request
-from typing import Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, Callable, List, Optional, Tuple
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    method: str = event.get('httpMethod', 'GET')
-    query_params = event.get('queryStringParameters', {}) or {}
-    room_id = query_params.get('room_id', '')
-    action = query_params.get('action', '')
-    
-    headers = event.get('headers', {})
-    auth_header = headers.get('authorization', headers.get('Authorization', ''))
-    token = auth_header.replace('Bearer ', '') if auth_header.startswith('Bearer ') else auth_header
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 204,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Auth-Token',
-                'Access-Control-Allow-Credentials': 'true',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    dsn = os.environ.get('DATABASE_URL')
-    if not dsn:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-            'body': json.dumps({'error': 'DATABASE_URL not configured'})
-        }
-    
-    conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+# Optional; responses fall back to the stdlib encoder. It pulls in datetime, uuid and
+# zoneinfo, so it is imported by the first response that encodes anything
+orjson: Any = None  # None until tried, False when it is not installed
+
+# Built once and shared by every response. Nothing mutates them in place:
+# finish_request_timer copies the headers before adding Server-Timing
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'}
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Auth-Token',
+    'Access-Control-Allow-Credentials': 'true',
+    'Access-Control-Max-Age': '86400'
+}
+METRICS_HEADERS = {'Content-Type': 'text/plain; version=0.0.4', 'Cache-Control': 'no-store'}
+ERROR_BODIES = {error: json.dumps({'error': error}) for error in (
+    'Forbidden', 'DATABASE_URL not configured', 'Unauthorized - token required', 'Method not allowed',
+    'Room not found', 'Not in room', 'limit, after_id and before_id must be integers',
+    'Name must be 1-20 characters', 'Capacity must be 2-20', 'Unknown user', 'Invalid JSON',
+    'room_full', 'already_in_room', 'empty', 'too_long', 'rate_limited', 'limit must be an integer',
+)}
+OK_BODY = json.dumps({'ok': True})
+
+
+# shared:begin responses, copied from backend/_shared/responses.py.in by scripts/sync_shared.py
+# Relies on imports: json, typing Any/Dict
+# Relies on the function for: JSON_HEADERS, ERROR_BODIES
+def load_orjson() -> None:
+    global orjson
+    try:
+        import orjson
+    except ImportError:
+        orjson = False
+
+
+def dump_json(value: Any) -> str:
+    if orjson is None:
+        load_orjson()
+    if orjson:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value)
+
+
+def json_response(status: int, body: str) -> Dict[str, Any]:
+    return {'statusCode': status, 'headers': JSON_HEADERS, 'body': body}
+
+
+def error_response(status: int, error: str) -> Dict[str, Any]:
+    return json_response(status, ERROR_BODIES.get(error) or json.dumps({'error': error}))
+# shared:end responses
+
+
+# psycopg2 adds ~20 ms to a cold start, so it is imported on the first connect instead:
+# preflights, the cached room list and rejected requests are answered without it
+psycopg2: Any = None
+sql: Any = None
+TRANSACTION_STATUS_IDLE: Any = None
+TimedDictCursor: Any = None
+driver_lock = threading.Lock()
+
+
+def load_driver() -> None:
+    global psycopg2, sql, TRANSACTION_STATUS_IDLE, TimedDictCursor
+    if psycopg2 is not None:
+        return
+    with driver_lock:
+        if psycopg2 is None:
+            from psycopg2 import sql
+            from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+            from psycopg2.extras import RealDictCursor
+            TimedDictCursor = make_timed_cursor(RealDictCursor)
+            # Bound last: once psycopg2 is set, everything above is too
+            import psycopg2
+
+
+# shared:begin pool, copied from backend/_shared/pool.py.in by scripts/sync_shared.py
+# Relies on imports: os, threading, time, typing Any/Callable/Dict/List/Tuple
+# Relies on the function for: psycopg2 and TRANSACTION_STATUS_IDLE, as load_driver binds them
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_ACQUIRE_TIMEOUT = 5.0
+DB_CONN_MAX_AGE = 300  # recycle connections older than 5 minutes
+DB_CONN_VALIDATE_AFTER = 30  # ping connections that sat idle longer than this
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+    '''Process-wide pool of PostgreSQL connections kept alive between warm invocations'''
+
+    def __init__(self, max_size: int, connect: Callable[[], Any]):
+        self.max_size = max_size
+        self._connect = connect
+        self._idle: List[Tuple[Any, float, float]] = []  # (conn, opened_at, released_at)
+        self._opened_at: Dict[int, float] = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self.stats = {'hits': 0, 'misses': 0, 'reconnects': 0, 'recycled': 0, 'discarded': 0}
+
+    def _open(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self._opened_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _drop(self, conn) -> None:
+        self._opened_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _ping(conn) -> bool:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire(self):
+        deadline = time.monotonic() + DB_POOL_ACQUIRE_TIMEOUT
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhausted('Connection pool exhausted')
+                self._cond.wait(remaining)
+            if not self._idle:
+                self._size += 1
+                self.stats['misses'] += 1
+                idle = None
+            else:
+                idle = self._idle.pop()
+        if idle is None:
+            return self._open()
+        
+        conn, opened_at, released_at = idle
+        now = time.monotonic()
+        if now - opened_at > DB_CONN_MAX_AGE:
+            self._drop(conn)
+            self.stats['recycled'] += 1
+            return self._open()
+        if conn.closed or (now - released_at > DB_CONN_VALIDATE_AFTER and not self._ping(conn)):
+            self._drop(conn)
+            self.stats['reconnects'] += 1
+            return self._open()
+        self.stats['hits'] += 1
+        return conn
+
+    def release(self, conn, discard: bool = False) -> None:
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        
+        if discard or conn.closed:
+            self._drop(conn)
+            with self._cond:
+                self._size -= 1
+                self.stats['discarded'] += 1
+                self._cond.notify()
+            return
+        
+        with self._cond:
+            self._idle.append((conn, self._opened_at.get(id(conn), 0.0), time.monotonic()))
+            self._cond.notify()
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._cond:
+            return dict(self.stats, size=self._size, idle=len(self._idle))
+# shared:end pool
+
+
+def open_connection():
+    load_driver()
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'), cursor_factory=TimedDictCursor)
     conn.autocommit = True
-    cursor = conn.cursor()
+    return conn
+
+
+db_pool = ConnectionPool(DB_POOL_MAX_SIZE, open_connection)
+
+# Build the message wire format in PostgreSQL and pass the JSON text straight through
+SQL_JSON_MESSAGES = os.environ.get('MESSAGES_SQL_JSON', '1') != '0'
+MESSAGE_COLUMNS = '''id, room_id, user_id, text, 
+               to_char(created_at, \'YYYY-MM-DD"T"HH24:MI:SS"Z"\') as created_at'''
+# Needs messages as m and a LEFT JOIN of users as u for the author
+MESSAGE_JSON = '''json_build_object(
+                   'id', m.id, 'room_id', m.room_id,
+                   'author', json_build_object('user_id', m.user_id, 'nick', u.nick, 'avatar_url', u.avatar_url, 'color', u.color),
+                   'text', m.text,
+                   'created_at', to_char(m.created_at, \'YYYY-MM-DD"T"HH24:MI:SS"Z"\'))'''
+
+
+def get_pool_stats() -> Dict[str, int]:
+    return db_pool.snapshot()
+
+
+# Every write to rooms takes its version from the rooms_version row in the same
+# statement. Writers queue on that row lock until the previous one commits, so
+# versions become visible in order: version > N never skips a later commit, and
+# rooms_version.version is the version of the whole list (V0009). The other
+# modifications filter on EXISTS (SELECT 1 FROM bump), so the version row is
+# always locked before any room or member row
+
+# Capacity check, membership insert and counter bump in one statement. The UPDATE
+# takes the room row lock and re-checks current_users < capacity after any
+# concurrent join commits, so a room can never be overfilled.
+JOIN_ROOM_SQL = '''
+WITH target AS (
+    SELECT room_id FROM rooms WHERE room_id = %(room_id)s
+), member AS (
+    SELECT 1 FROM room_members WHERE room_id = %(room_id)s AND user_id = %(user_id)s
+), bump AS (
+    -- Skipped only when joined cannot match; a join that finds the room full still bumps
+    UPDATE rooms_version SET version = version + 1
+    WHERE EXISTS (SELECT 1 FROM target) AND NOT EXISTS (SELECT 1 FROM member)
+    RETURNING version
+), joined AS (
+    UPDATE rooms SET current_users = current_users + 1, version = (SELECT version FROM bump)
+    WHERE room_id = %(room_id)s AND current_users < capacity AND EXISTS (SELECT 1 FROM bump)
+    RETURNING room_id, name, capacity, current_users
+), inserted AS (
+    INSERT INTO room_members (room_id, user_id)
+    SELECT room_id, %(user_id)s FROM joined
+)
+SELECT joined.room_id, joined.name, joined.capacity, joined.current_users AS current,
+       EXISTS (SELECT 1 FROM target) AS room_exists,
+       EXISTS (SELECT 1 FROM member) AS already_member
+FROM (SELECT 1) AS one LEFT JOIN joined ON TRUE
+'''
+
+LEAVE_ROOM_SQL = '''
+WITH bump AS (
+    UPDATE rooms_version SET version = version + 1
+    WHERE EXISTS (SELECT 1 FROM room_members WHERE room_id = %(room_id)s AND user_id = %(user_id)s)
+    RETURNING version
+), removed AS (
+    DELETE FROM room_members
+    WHERE room_id = %(room_id)s AND user_id = %(user_id)s AND EXISTS (SELECT 1 FROM bump)
+    RETURNING room_id
+), updated AS (
+    UPDATE rooms SET current_users = GREATEST(0, current_users - 1), version = (SELECT version FROM bump)
+    WHERE room_id IN (SELECT room_id FROM removed)
+)
+SELECT EXISTS (SELECT 1 FROM removed) AS removed
+'''
+
+ROOMS_CACHE_TTL = 1.0  # serve the room list without asking PostgreSQL for this long
+ROOMS_LIST_LIMIT = 200
+
+# rooms_version.version identifies the state of the whole list and version > N selects what changed
+rooms_cache_lock = threading.Lock()
+rooms_cache: Optional[Tuple[float, int, str]] = None  # (checked_at, version, body)
+
+
+def get_fresh_rooms_cache() -> Optional[Tuple[int, str]]:
+    cached = rooms_cache
+    if cached is None or time.monotonic() - cached[0] > ROOMS_CACHE_TTL:
+        return None
+    return cached[1], cached[2]
+
+
+def store_rooms_cache(version: int, body: str) -> None:
+    global rooms_cache
+    with rooms_cache_lock:
+        rooms_cache = (time.monotonic(), version, body)
+
+
+def invalidate_rooms_cache() -> None:
+    global rooms_cache
+    with rooms_cache_lock:
+        rooms_cache = None
+
+
+rooms_list_headers: Tuple[int, Dict[str, str]] = (-1, {})  # (version, headers) of the latest list response
+
+
+def rooms_list_response(event: Dict[str, Any], version: int, body: str) -> Dict[str, Any]:
+    global rooms_list_headers
+    headers = event.get('headers', {}) or {}
+    if_none_match = headers.get('If-None-Match') or headers.get('if-none-match')
+    cached_version, response_headers = rooms_list_headers
+    if cached_version != version:
+        response_headers = dict(JSON_HEADERS, **{
+            'Access-Control-Expose-Headers': 'ETag, X-Rooms-Version',
+            'Cache-Control': 'no-cache',
+            'ETag': f'"rooms-{version}"',
+            'X-Rooms-Version': str(version)
+        })
+        rooms_list_headers = (version, response_headers)
+    etag = response_headers['ETag']
     
-    protected_actions = ['members', 'messages', 'send', 'leave']
-    needs_auth = (action in protected_actions) or (method == 'POST' and action in ['send', 'leave'])
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return {'statusCode': 304, 'headers': response_headers, 'body': ''}
     
-    if needs_auth:
-        if not token or len(token) < 10:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 401,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Credentials': 'true'
-                },
-                'body': json.dumps({'error': 'Unauthorized - token required'})
-            }
-    
-    if method == 'GET' and not room_id:
-        cursor.execute('SELECT room_id, name, capacity, current_users as current FROM rooms ORDER BY created_at DESC')
-        rooms = [dict(row) for row in cursor.fetchall()]
-        cursor.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Credentials': 'true'
-            },
-            'body': json.dumps(rooms)
-        }
-    
-    if method == 'GET' and room_id and not action:
-        cursor.execute('SELECT room_id, name, capacity, current_users as current FROM rooms WHERE room_id = %s', (room_id,))
-        room = cursor.fetchone()
-        cursor.close()
-        conn.close()
+    return {'statusCode': 200, 'headers': response_headers, 'body': body}
+
+
+def rooms_delta_response(version: int, rooms: List[Dict[str, Any]], more: bool) -> Dict[str, Any]:
+    return json_response(200, dump_json({'version': version, 'rooms': rooms, 'more': more}))
+
+
+def parse_since_version(query_params: Dict[str, str]) -> Optional[int]:
+    try:
+        return int(query_params['since_version']) if query_params.get('since_version') else None
+    except ValueError:
+        return None
+
+
+WS_MESSAGES_URL = os.environ.get('WS_MESSAGES_URL', 'https://functions.poehali.dev/7656a328-0a04-4d38-bbeb-761617c1247e')
+BROADCAST_QUEUE_MAX = 1000
+BROADCAST_BATCH_MAX = 50
+BROADCAST_BATCH_WINDOW = 0.02  # wait this long for more messages before posting a batch
+BROADCAST_TIMEOUT = 2.0
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_BACKOFF = 0.1
+BROADCAST_BACKOFF_MAX = 1.0
+
+
+class BroadcastDispatcher:
+    '''Posts broadcasts to ws-messages from a background thread, coalescing bursts into one array POST'''
+
+    def __init__(self, url: str):
+        self._url = url
+        self._path = '/'  # taken from the URL when the first connection opens
+        self._queue: 'queue.Queue[str]' = queue.Queue(maxsize=BROADCAST_QUEUE_MAX)
+        self._conn = None  # http.client.HTTPConnection, opened on the first POST
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.stats = {'sent': 0, 'batches': 0, 'retries': 0, 'dropped': 0, 'throttled': 0}
+        # A host running ws-messages in the same process can hand batches over directly: (body, headers) -> status
+        self.deliver: Optional[Callable[[bytes, Dict[str, str]], int]] = None
+
+    def submit(self, payload: str) -> None:
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(payload)
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+    def _ensure_worker(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='broadcast-dispatcher', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + BROADCAST_BATCH_WINDOW
+            while len(batch) < BROADCAST_BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._send(batch)
+
+    def _connection(self):
+        if self._conn is None:
+            # Only the http bus posts anywhere, so these ~30 ms of imports stay out of the cold start
+            import http.client
+            import urllib.parse
+            parts = urllib.parse.urlsplit(self._url)
+            self._path = parts.path or '/'
+            conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            self._conn = conn_class(parts.netloc, timeout=BROADCAST_TIMEOUT)
+        return self._conn
+
+    def _reset_connection(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _send(self, batch: List[str]) -> None:
+        import http.client
         
-        if not room:
-            return {
-                'statusCode': 404,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Credentials': 'true'
-                },
-                'body': json.dumps({'error': 'Room not found'})
-            }
+        body = ('[' + ','.join(batch) + ']').encode('utf-8')
+        delay = BROADCAST_BACKOFF
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            started = time.perf_counter()
+            try:
+                status = self._post(body)
+                metrics.observe('broadcast', 'http', time.perf_counter() - started)
+                if status == 429:
+                    # ws-messages shed the batch; retrying would only add to the flood
+                    self.stats['throttled'] += len(batch)
+                    return
+                if status < 500:
+                    self.stats['sent'] += len(batch)
+                    self.stats['batches'] += 1
+                    return
+            except (OSError, http.client.HTTPException):
+                self._reset_connection()
+            
+            if attempt + 1 < BROADCAST_MAX_ATTEMPTS:
+                self.stats['retries'] += 1
+                time.sleep(delay)
+                delay = min(delay * 2, BROADCAST_BACKOFF_MAX)
         
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Credentials': 'true'
-            },
-            'body': json.dumps(dict(room))
-        }
-    
-    if method == 'GET' and room_id and action == 'members':
+        self.stats['dropped'] += len(batch)
+
+    def _post(self, body: bytes) -> int:
+        headers = {'Content-Type': 'application/json', 'X-Broadcast-Signature': sign_broadcast(body)}
+        if self.deliver is not None:
+            return self.deliver(body, headers)
+        conn = self._connection()
+        conn.request('POST', self._path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+
+
+def sign_broadcast(body: bytes) -> str:
+    '''X-Broadcast-Signature for a POST to ws-messages, which accepts only broadcasts signed with TOKEN_SECRET'''
+    signed_at = int(time.time())
+    signature = hmac.new(TOKEN_SECRET.encode('utf-8'), f'{signed_at}.'.encode('utf-8') + body, hashlib.sha256).hexdigest()
+    return f't={signed_at},v1={signature}'
+
+
+broadcaster = BroadcastDispatcher(WS_MESSAGES_URL)
+
+# 'notify' publishes sends on a PostgreSQL channel every ws-messages instance LISTENs on;
+# 'http' posts them to WS_MESSAGES_URL, which only reaches the instance that takes the POST
+MESSAGE_BUS = os.environ.get('MESSAGE_BUS', 'notify')
+MESSAGE_BUS_CHANNEL = 'room_messages'
+NOTIFY_PAYLOAD_MAX = 7900  # PostgreSQL rejects payloads of 8000 bytes and more
+
+# Ids are drawn before the INSERT so each row maps back to its sender. prev_id is the
+# newest message of the room before this one (the previous row of the same room in the
+# batch, else the newest stored row); listeners that did not see it know they missed a
+# notification and backfill from the table
+INSERT_MESSAGES_SQL = '''
+WITH batch AS (
+    SELECT nextval('messages_id_seq')::int AS id, b.room_id, b.user_id, b.text, b.ord
+    FROM unnest(%s::text[], %s::text[], %s::text[]) WITH ORDINALITY AS b(room_id, user_id, text, ord)
+), previous AS (
+    SELECT r.room_id, (SELECT max(id) FROM messages WHERE room_id = r.room_id) AS prev_id
+    FROM (SELECT DISTINCT room_id FROM batch) r
+), inserted AS (
+    INSERT INTO messages (id, room_id, user_id, text)
+    SELECT id, room_id, user_id, text FROM batch
+    RETURNING id, created_at
+)
+SELECT b.id, to_char(i.created_at, 'YYYY-MM-DD"T"HH24:MI:SS"Z"') AS created_at,
+       coalesce(lag(b.id) OVER (PARTITION BY b.room_id ORDER BY b.id), p.prev_id) AS prev_id
+FROM batch b
+JOIN inserted i ON i.id = b.id
+LEFT JOIN previous p ON p.room_id = b.room_id
+ORDER BY b.ord'''
+
+SEND_BATCH_MAX = 100  # sends written by one INSERT
+SEND_BATCH_WINDOW = float(os.environ.get('SEND_BATCH_WINDOW', '0.001'))  # while sends queue up, the next writer waits this long for more
+
+
+class PendingMessage:
+    '''One send waiting for its batch; the writer fills in author and message_json, or error'''
+    
+    __slots__ = ('room_id', 'user_id', 'text', 'author', 'done', 'leads', 'conn', 'message_json', 'error')
+    
+    def __init__(self, room_id: str, user_id: str, text: str):
+        self.room_id = room_id
+        self.user_id = user_id
+        self.text = text
+        self.author: Optional[Dict[str, str]] = None
+        self.done = threading.Event()
+        self.leads = False
+        self.conn = None  # handed over with the lead while a burst lasts
+        self.message_json: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+
+class MessageBatcher:
+    '''Group commit for sends: one caller at a time writes and publishes everything queued; the
+    others wait without a connection and the next in line takes over the writer's connection'''
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: List[PendingMessage] = []
+        self._writing = False
+        self.stats = {'batches': 0, 'messages': 0, 'largest': 0}
+    
+    def send(self, message: PendingMessage) -> Optional[str]:
+        '''The message JSON as written, or None when the sender is not a known user'''
+        with self._lock:
+            self._pending.append(message)
+            message.leads = not self._writing
+            self._writing = True
+        if not message.leads:
+            message.done.wait()
+            if message.leads:
+                # Handed over by the previous writer while sends were queued: let the burst grow a little
+                time.sleep(SEND_BATCH_WINDOW)
+        if message.leads:
+            self._write(message.conn)
+        if message.error is not None:
+            raise message.error
+        return message.message_json
+    
+    def _write(self, conn) -> None:
+        timer = current_timer()
+        batch: List[PendingMessage] = []
+        broken = False
+        try:
+            if conn is None:
+                with timer.phase('db_acquire'):
+                    conn = db_pool.acquire()
+            # Taken once connected, so sends that queued meanwhile join this batch
+            batch = self._take_batch()
+            with conn.cursor() as cursor:
+                self._insert(cursor, batch)
+        except BaseException as error:
+            broken = isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            if conn is None:
+                batch = self._take_batch()
+            for message in batch:
+                message.error = error
+        finally:
+            with self._lock:
+                if self._pending:
+                    successor = self._pending[0]
+                    successor.leads = True
+                    if not broken:
+                        # Queueing in the pool again would stall every send behind it
+                        successor.conn, conn = conn, None
+                    successor.done.set()
+                else:
+                    self._writing = False
+            if conn is not None:
+                with timer.phase('db_release'):
+                    db_pool.release(conn, discard=broken)
+            for message in batch:
+                message.done.set()
+    
+    def _take_batch(self) -> List[PendingMessage]:
+        with self._lock:
+            batch = self._pending[:SEND_BATCH_MAX]
+            del self._pending[:SEND_BATCH_MAX]
+            self.stats['batches'] += 1
+            self.stats['messages'] += len(batch)
+            self.stats['largest'] = max(self.stats['largest'], len(batch))
+        return batch
+    
+    @staticmethod
+    def _insert(cursor, batch: List[PendingMessage]) -> None:
+        profiles = get_profiles(cursor, [message.user_id for message in batch])
+        for message in batch:
+            message.author = profiles.get(message.user_id)
+        # Unknown senders are answered 403 by send_message and written by nobody
+        batch = [message for message in batch if message.author is not None]
+        if not batch:
+            return
+        cursor.execute(INSERT_MESSAGES_SQL, (
+            [message.room_id for message in batch],
+            [message.user_id for message in batch],
+            [message.text for message in batch]
+        ))
+        rows = cursor.fetchall()
+        for message, row in zip(batch, rows):
+            message.message_json = dump_json({
+                'id': row['id'],
+                'room_id': message.room_id,
+                'author': message.author,
+                'text': message.text,
+                'created_at': row['created_at']
+            })
+        publish_messages(cursor, batch, rows)
+
+
+message_batcher = MessageBatcher()
+
+
+def publish_messages(cursor, batch: List[PendingMessage], rows: List[Dict[str, Any]]) -> None:
+    if MESSAGE_BUS != 'notify':
+        # Broadcast to WebSocket server without holding up the response
+        for message in batch:
+            broadcaster.submit(f'{{"room_id": {json.dumps(message.room_id)}, "message": {message.message_json}}}')
+        return
+    
+    payloads = []
+    for message, row in zip(batch, rows):
+        head = f'{{"room_id": {json.dumps(message.room_id)}, "id": {row["id"]}, "prev_id": {json.dumps(row["prev_id"])}'
+        payload = f'{head}, "message": {message.message_json}}}'
+        if len(payload.encode('utf-8')) > NOTIFY_PAYLOAD_MAX:
+            # Large avatars do not fit; listeners load the row by id instead
+            payload = head + '}'
+        payloads.append(payload)
+    cursor.execute('SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload', (MESSAGE_BUS_CHANNEL, payloads))
+
+
+# messages is range-partitioned by created_at (V0008); old history leaves by whole partitions
+MESSAGE_PARTITION_DAYS = 7
+MESSAGE_PARTITION_EPOCH = date(2024, 1, 1)  # a Monday, so partitions run Monday to Monday
+MESSAGE_PARTITIONS_AHEAD = 1  # next week's partition exists well before the hourly upkeep would be late
+MESSAGE_RETENTION_DAYS = int(os.environ.get('MESSAGE_RETENTION_DAYS', '28'))
+MESSAGE_ROOM_CAP = int(os.environ.get('MESSAGE_ROOM_CAP', '1000'))  # newest messages kept per room, 0 keeps all
+MESSAGE_ARCHIVE = os.environ.get('MESSAGE_ARCHIVE', '0') == '1'  # detach expired partitions for scripts/archive_messages.py instead of dropping them
+MAINTENANCE_INTERVAL = 3600  # partition upkeep at most once an hour per instance
+MAINTENANCE_LOCK_ID = 7340402  # advisory lock so concurrent instances do not maintain together
+PARTITION_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+logger = logging.getLogger(__name__)
+maintenance_lock = threading.Lock()
+last_maintenance = float('-inf')  # monotonic() starts near zero on a freshly booted instance
+# Exported as messages_maintenance_*; alert on failures or on default_rows staying above zero
+maintenance_stats = {'runs': 0, 'failures': 0, 'rescued_rows': 0, 'default_rows': 0}
+
+
+def partition_start(day: date) -> date:
+    offset = (day - MESSAGE_PARTITION_EPOCH).days % MESSAGE_PARTITION_DAYS
+    return day - timedelta(days=offset)
+
+
+def list_message_partitions(cursor) -> List[Tuple[str, Optional[datetime]]]:
+    cursor.execute(
+        '''SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+           FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = 'messages'::regclass'''
+    )
+    partitions = []
+    for row in cursor.fetchall():
+        match = PARTITION_UPPER_BOUND.search(row['bound'])
+        partitions.append((row['name'], datetime.fromisoformat(match.group(1)) if match else None))
+    return partitions
+
+
+def retention_cutoff(today: date) -> datetime:
+    '''Partitions that end at or before this are retired'''
+    return datetime.combine(today - timedelta(days=MESSAGE_RETENTION_DAYS), datetime.min.time())
+
+
+def create_message_partitions(cursor, today: date, partitions: List[Tuple[str, Optional[datetime]]]) -> None:
+    # From the newest partition on, not from this week: weeks missed while upkeep was not running
+    # get their partition too, and rescue_default_rows moves their rows out of messages_default
+    uppers = [upper for _, upper in partitions if upper]
+    start = max(uppers) if uppers else datetime.combine(partition_start(today), datetime.min.time())
+    horizon = datetime.combine(today + timedelta(days=MESSAGE_PARTITION_DAYS * MESSAGE_PARTITIONS_AHEAD), datetime.min.time())
+    cutoff = retention_cutoff(today)
+    while start < horizon:
+        end = datetime.combine(partition_start(start.date()) + timedelta(days=MESSAGE_PARTITION_DAYS), datetime.min.time())
+        create_partition = sql.SQL('CREATE TABLE IF NOT EXISTS {} PARTITION OF messages FOR VALUES FROM (%s) TO (%s)').format(
+            sql.Identifier(f'messages_p{start:%Y%m%d}')
+        )
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM messages_default WHERE created_at >= %s AND created_at < %s) AS stranded', (start, end))
+        if cursor.fetchone()['stranded']:
+            rescue_default_rows(cursor, create_partition, start, end)
+        elif end > cutoff:
+            # An empty week already past retention would only be retired again
+            cursor.execute(create_partition, (start, end))
+        start = end
+
+
+def rescue_default_rows(cursor, create_partition, start: datetime, end: datetime) -> None:
+    '''Creates the partition for rows that landed in messages_default while it was missing'''
+    # PostgreSQL refuses to create it next to those rows: detach the default partition, create
+    # the new one, move the rows through the parent and attach again, in one transaction.
+    # Sends wait on the table lock for that long
+    cursor.execute('BEGIN')
+    try:
+        cursor.execute('ALTER TABLE messages DETACH PARTITION messages_default')
+        cursor.execute(create_partition, (start, end))
         cursor.execute(
-            'SELECT user_id, nick, avatar_url, color FROM room_members WHERE room_id = %s ORDER BY joined_at',
-            (room_id,)
+            '''WITH moved AS (
+                   DELETE FROM messages_default WHERE created_at >= %s AND created_at < %s
+                   RETURNING id, room_id, user_id, text, created_at
+               )
+               INSERT INTO messages (id, room_id, user_id, text, created_at) SELECT * FROM moved''',
+            (start, end)
         )
-        members = [dict(row) for row in cursor.fetchall()]
-        cursor.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Credentials': 'true'
-            },
-            'body': json.dumps(members)
-        }
-    
-    if method == 'GET' and room_id and action == 'messages':
-        query_params = event.get('queryStringParameters', {})
+        moved = cursor.rowcount
+        cursor.execute('ALTER TABLE messages ATTACH PARTITION messages_default DEFAULT')
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    maintenance_stats['rescued_rows'] += moved
+    logger.error('moved %d messages from messages_default into the partition starting %s; upkeep had fallen behind', moved, start)
+
+
+def retire_message_partitions(cursor, today: date, partitions: List[Tuple[str, Optional[datetime]]]) -> None:
+    cutoff = retention_cutoff(today)
+    for name, upper in partitions:
+        if upper is None or upper > cutoff:
+            continue
+        if MESSAGE_ARCHIVE:
+            # Detaching is a catalog change; the rows stay put until the export drops the table
+            cursor.execute(sql.SQL('ALTER TABLE messages DETACH PARTITION {}').format(sql.Identifier(name)))
+            cursor.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(
+                sql.Identifier(name), sql.Identifier(name.replace('messages_', 'messages_archive_', 1))
+            ))
+        else:
+            cursor.execute(sql.SQL('DROP TABLE {}').format(sql.Identifier(name)))
+
+
+def cap_room_messages(cursor) -> None:
+    # Only rooms over the cap lose rows: the (room_id, id) index finds each room's cutoff id
+    cursor.execute(
+        '''DELETE FROM messages m
+           USING (
+               SELECT r.room_id, c.id AS cutoff_id FROM rooms r
+               CROSS JOIN LATERAL (
+                   SELECT id FROM messages WHERE room_id = r.room_id ORDER BY id DESC OFFSET %s LIMIT 1
+               ) c
+           ) capped
+           WHERE m.room_id = capped.room_id AND m.id <= capped.cutoff_id''',
+        (MESSAGE_ROOM_CAP,)
+    )
+
+
+def maintain_messages() -> None:
+    conn = None
+    broken = False
+    try:
+        # Inside the try: a failed connect must still free maintenance_lock for the next attempt
+        conn = db_pool.acquire()
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s) AS locked, CURRENT_DATE AS today', (MAINTENANCE_LOCK_ID,))
+            row = cursor.fetchone()
+            if row['locked']:
+                try:
+                    create_message_partitions(cursor, row['today'], list_message_partitions(cursor))
+                    # Listed again: a rescued week can already be past retention
+                    retire_message_partitions(cursor, row['today'], list_message_partitions(cursor))
+                    if MESSAGE_ROOM_CAP > 0:
+                        cap_room_messages(cursor)
+                    cursor.execute('SELECT count(*) AS n FROM messages_default')
+                    maintenance_stats['default_rows'] = cursor.fetchone()['n']
+                    maintenance_stats['runs'] += 1
+                finally:
+                    cursor.execute('SELECT pg_advisory_unlock(%s)', (MAINTENANCE_LOCK_ID,))
+    except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolExhausted) as error:
+        broken = not isinstance(error, PoolExhausted)
+        maintenance_stats['failures'] += 1
+        logger.error('messages maintenance could not run: %s', error)
+    except psycopg2.Error as error:
+        # Partitions stop being created and retention stops until this is fixed
+        maintenance_stats['failures'] += 1
+        logger.error('messages maintenance failed: %s', error)
+    finally:
+        if conn is not None:
+            db_pool.release(conn, discard=broken)
+        maintenance_lock.release()
+
+
+def maybe_start_maintenance() -> None:
+    global last_maintenance
+    now = time.monotonic()
+    if now - last_maintenance < MAINTENANCE_INTERVAL or not maintenance_lock.acquire(blocking=False):
+        return
+    last_maintenance = now
+    try:
+        threading.Thread(target=maintain_messages, name='messages-maintenance', daemon=True).start()
+    except RuntimeError:
+        maintenance_lock.release()
+
+
+# shared:begin metrics, copied from backend/_shared/metrics.py.in by scripts/sync_shared.py
+# Relies on imports: hmac, os, random, threading, time, bisect_left, typing Any/Dict/List/Tuple
+# Relies on the function for: METRICS_HEADERS, error_response (responses block), metrics = Metrics('<function>'), metrics_gauges()
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.05'))  # share of requests timed phase by phase
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # GET ?action=metrics needs a matching X-Metrics-Token; unset, there is no metrics endpoint
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+
+class RequestTimer:
+    '''Phase timings and row count of one sampled request'''
+    
+    sampled = True
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self.rows = 0
+    
+    def phase(self, name: str) -> 'TimedPhase':
+        return TimedPhase(self, name)
+    
+    def add(self, name: str, duration: float, rows: int = 0) -> None:
+        self.phases.append((name, duration))
+        self.rows += rows
+
+
+class TimedPhase:
+    __slots__ = ('timer', 'name', 'started')
+    
+    def __init__(self, timer: RequestTimer, name: str):
+        self.timer = timer
+        self.name = name
+        self.started = 0.0
+    
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+    
+    def __exit__(self, *exc_info) -> None:
+        self.timer.add(self.name, time.perf_counter() - self.started)
+
+
+class NoopTimer:
+    '''Stands in for RequestTimer on requests that are not sampled, so timing calls cost next to nothing'''
+    
+    sampled = False
+    
+    def phase(self, name: str) -> 'NoopTimer':
+        return self
+    
+    def add(self, name: str, duration: float, rows: int = 0) -> None:
+        pass
+    
+    def __enter__(self) -> None:
+        pass
+    
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+NOOP_TIMER = NoopTimer()
+timer_local = threading.local()
+
+
+def current_timer():
+    return getattr(timer_local, 'timer', NOOP_TIMER)
+
+
+class Metrics:
+    '''Process-wide request counters and sampled phase histograms, rendered in Prometheus text format'''
+    
+    def __init__(self, function: str):
+        self.function = function
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, int], int] = {}
+        self.phases: Dict[Tuple[str, str], List[float]] = {}  # bucket counts, then count and sum
+        self.rows: Dict[str, int] = {}
+        self.response_bytes: Dict[str, int] = {}
+    
+    def _observe(self, route: str, phase: str, duration: float) -> None:
+        histogram = self.phases.get((route, phase))
+        if histogram is None:
+            histogram = [0] * (len(METRICS_BUCKETS) + 3)
+            self.phases[(route, phase)] = histogram
+        histogram[bisect_left(METRICS_BUCKETS, duration)] += 1
+        histogram[-2] += 1
+        histogram[-1] += duration
+    
+    def observe(self, route: str, phase: str, duration: float) -> None:
+        with self._lock:
+            self._observe(route, phase, duration)
+    
+    def record(self, route: str, status: int, timer, total: float, body_bytes: int) -> None:
+        with self._lock:
+            self.requests[(route, status)] = self.requests.get((route, status), 0) + 1
+            if not timer.sampled:
+                return
+            self._observe(route, 'total', total)
+            for phase, duration in timer.phases:
+                self._observe(route, phase, duration)
+            self.rows[route] = self.rows.get(route, 0) + timer.rows
+            self.response_bytes[route] = self.response_bytes.get(route, 0) + body_bytes
+    
+    def render(self, gauges: Dict[str, float]) -> str:
+        fn = self.function
+        lines = ['# TYPE handler_requests_total counter']
+        with self._lock:
+            for (route, status), count in sorted(self.requests.items()):
+                lines.append(f'handler_requests_total{{function="{fn}",route="{route}",status="{status}"}} {count}')
+            lines.append('# TYPE handler_phase_seconds histogram')
+            for (route, phase), histogram in sorted(self.phases.items()):
+                labels = f'function="{fn}",route="{route}",phase="{phase}"'
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS, histogram):
+                    cumulative += count
+                    lines.append(f'handler_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'handler_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram[-2]}')
+                lines.append(f'handler_phase_seconds_count{{{labels}}} {histogram[-2]}')
+                lines.append(f'handler_phase_seconds_sum{{{labels}}} {histogram[-1]:.6f}')
+            lines.append('# TYPE handler_sampled_rows_total counter')
+            for route, rows in sorted(self.rows.items()):
+                lines.append(f'handler_sampled_rows_total{{function="{fn}",route="{route}"}} {rows}')
+            lines.append('# TYPE handler_sampled_response_bytes_total counter')
+            for route, size in sorted(self.response_bytes.items()):
+                lines.append(f'handler_sampled_response_bytes_total{{function="{fn}",route="{route}"}} {size}')
+        for name, value in gauges.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{{function="{fn}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def start_request_timer():
+    timer = RequestTimer() if random.random() < METRICS_SAMPLE_RATE else NOOP_TIMER
+    timer_local.timer = timer
+    return timer
+
+
+def finish_request_timer(timer, route: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    timer_local.timer = NOOP_TIMER
+    status = response.get('statusCode', 200)
+    if not timer.sampled:
+        metrics.record(route, status, timer, 0.0, 0)
+        return response
+    
+    total = time.perf_counter() - timer.started
+    metrics.record(route, status, timer, total, len((response.get('body') or '').encode('utf-8')))
+    server_timing = [f'{name};dur={duration * 1000:.2f}' for name, duration in timer.phases]
+    server_timing.append(f'total;dur={total * 1000:.2f}')
+    response['headers'] = dict(response.get('headers') or {}, **{
+        'Server-Timing': ', '.join(server_timing),
+        'Timing-Allow-Origin': '*'
+    })
+    return response
+
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    headers = event.get('headers', {}) or {}
+    supplied = headers.get('X-Metrics-Token') or headers.get('x-metrics-token') or ''
+    if not METRICS_TOKEN:
+        # Pool, cache and bus internals stay private unless a scraper is configured
+        return error_response(404, 'Not found')
+    if not hmac.compare_digest(supplied.encode('utf-8'), METRICS_TOKEN.encode('utf-8')):
+        return error_response(403, 'Forbidden')
+    return {
+        'statusCode': 200,
+        'headers': METRICS_HEADERS,
+        'body': metrics.render(metrics_gauges())
+    }
+# shared:end metrics
+
+
+metrics = Metrics('rooms')
+
+
+# shared:begin timed_cursor, copied from backend/_shared/timed_cursor.py.in by scripts/sync_shared.py
+# Relies on imports: time
+# Relies on the function for: current_timer (metrics block)
+def make_timed_cursor(base: type) -> type:
+    '''RealDictCursor subclass that reports every statement to the current request's timer'''
+    
+    class TimedDictCursor(base):
+        def execute(self, query, vars=None):
+            timer = current_timer()
+            if not timer.sampled:
+                return super().execute(query, vars)
+            started = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                timer.add('sql', time.perf_counter() - started, max(self.rowcount, 0))
+    
+    return TimedDictCursor
+# shared:end timed_cursor
+
+
+ROUTE_ACTIONS = ('members', 'messages', 'snapshot', 'send', 'join', 'leave')
+
+
+def route_label(event: Dict[str, Any]) -> str:
+    query_params = event.get('queryStringParameters') or {}
+    action = query_params.get('action', '')
+    if action:
+        name = action if action in ROUTE_ACTIONS else 'other'
+    else:
+        name = 'room' if query_params.get('room_id') else 'list'
+    return f"{event.get('httpMethod', 'GET')} {name}"
+
+
+def metrics_gauges() -> Dict[str, float]:
+    gauges = {f'db_pool_{name}': value for name, value in get_pool_stats().items()}
+    gauges.update({f'broadcast_{name}': value for name, value in broadcaster.stats.items()})
+    gauges.update({f'send_batch_{name}': value for name, value in message_batcher.stats.items()})
+    gauges.update({f'send_limit_user_{name}': value for name, value in user_send_buckets.stats.items()})
+    gauges.update({f'send_limit_room_{name}': value for name, value in room_send_buckets.stats.items()})
+    gauges.update({f'messages_maintenance_{name}': value for name, value in maintenance_stats.items()})
+    return gauges
+
+
+PROFILE_CACHE_SIZE = 10000  # guest profiles never change, so entries only leave through LRU eviction
+
+profile_lock = threading.Lock()
+profile_cache: 'OrderedDict[str, Dict[str, str]]' = OrderedDict()
+
+
+def get_profiles(cursor, user_ids: List[str]) -> Dict[str, Dict[str, str]]:
+    '''{user_id: {user_id, nick, avatar_url, color}} from the in-process cache, loading misses in one query'''
+    profiles: Dict[str, Dict[str, str]] = {}
+    with profile_lock:
+        for user_id in user_ids:
+            profile = profile_cache.get(user_id)
+            if profile is not None:
+                profile_cache.move_to_end(user_id)
+                profiles[user_id] = profile
+    
+    missing = list({user_id for user_id in user_ids if user_id not in profiles})
+    if missing:
+        cursor.execute('SELECT user_id, nick, avatar_url, color FROM users WHERE user_id = ANY(%s)', (missing,))
+        rows = cursor.fetchall()
+        with profile_lock:
+            for row in rows:
+                profile = dict(row)
+                profile_cache[profile['user_id']] = profile
+                profiles[profile['user_id']] = profile
+            while len(profile_cache) > PROFILE_CACHE_SIZE:
+                profile_cache.popitem(last=False)
+    return profiles
+
+
+# shared:begin tokens, copied from backend/_shared/tokens.py.in by scripts/sync_shared.py
+# Relies on imports: base64, hashlib, hmac, json, os, threading, time, OrderedDict, typing Any/Dict/Optional
+TOKEN_SECRET = os.environ.get('TOKEN_SECRET', '')  # shared with auth, which signs the tokens
+TOKEN_CACHE_SIZE = 4096  # recently verified tokens kept to skip the HMAC on every poll
+
+token_cache_lock = threading.Lock()
+token_cache: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+
+
+def decode_token_segment(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def verify_token(token: Optional[str]) -> Optional[Dict[str, Any]]:
+    '''Claims ({user_id, nick, color, exp}) of an unexpired token signed by auth, else None'''
+    if not token or not TOKEN_SECRET:
+        return None
+    
+    with token_cache_lock:
+        claims = token_cache.get(token)
+        if claims is not None:
+            token_cache.move_to_end(token)
+    
+    if claims is None:
+        version, _, rest = token.partition('.')
+        payload, _, signature = rest.partition('.')
+        if version != 'v1' or not payload or not signature:
+            return None
+        expected = hmac.new(TOKEN_SECRET.encode('utf-8'), f'v1.{payload}'.encode('utf-8'), hashlib.sha256).digest()
+        try:
+            if not hmac.compare_digest(decode_token_segment(signature), expected):
+                return None
+            claims = json.loads(decode_token_segment(payload))
+        except ValueError:
+            return None
+        if not isinstance(claims, dict) or not isinstance(claims.get('exp'), int) or not claims.get('user_id'):
+            return None
+        with token_cache_lock:
+            token_cache[token] = claims
+            if len(token_cache) > TOKEN_CACHE_SIZE:
+                token_cache.popitem(last=False)
+    
+    if claims['exp'] <= time.time():
+        return None
+    return claims
+# shared:end tokens
+
+
+# Sends are limited per user and per room, in memory, so each instance enforces its own budget
+SEND_USER_RATE = float(os.environ.get('SEND_USER_RATE', '1'))  # sustained sends per second, 0 disables
+SEND_USER_BURST = float(os.environ.get('SEND_USER_BURST', '5'))
+SEND_ROOM_RATE = float(os.environ.get('SEND_ROOM_RATE', '10'))
+SEND_ROOM_BURST = float(os.environ.get('SEND_ROOM_BURST', '20'))
+RATE_LIMIT_KEYS = 10000  # buckets kept per limiter; the least recently used go first
+# shared:begin rate_limit, copied from backend/_shared/rate_limit.py.in by scripts/sync_shared.py
+# Relies on imports: math, threading, time, OrderedDict, typing Any/Dict
+# Relies on the function for: JSON_HEADERS, ERROR_BODIES with 'rate_limited'
+RATE_LIMITED_HEADERS = dict(JSON_HEADERS, **{'Access-Control-Expose-Headers': 'Retry-After'})
+
+
+class TokenBuckets:
+    '''One token bucket per key, refilled lazily when the key is next used'''
+    
+    def __init__(self, rate: float, burst: float, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets: 'OrderedDict[str, List[float]]' = OrderedDict()  # key -> [tokens, refilled_at]
+        self.stats = {'limited': 0, 'evicted': 0}
+    
+    def take(self, key: str, cost: float = 1.0) -> float:
+        '''0 when the tokens were taken, else the seconds until they will be there'''
+        if self.rate <= 0:
+            return 0.0
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+                    self.stats['evicted'] += 1
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            self.stats['limited'] += 1
+            return (cost - bucket[0]) / self.rate
+    
+    def refund(self, key: str, cost: float = 1.0) -> None:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + cost)
+
+
+def rate_limited_response(wait: float) -> Dict[str, Any]:
+    headers = dict(RATE_LIMITED_HEADERS, **{'Retry-After': str(max(1, math.ceil(wait)))})
+    return {'statusCode': 429, 'headers': headers, 'body': ERROR_BODIES['rate_limited']}
+# shared:end rate_limit
+
+
+user_send_buckets = TokenBuckets(SEND_USER_RATE, SEND_USER_BURST, RATE_LIMIT_KEYS)
+room_send_buckets = TokenBuckets(SEND_ROOM_RATE, SEND_ROOM_BURST, RATE_LIMIT_KEYS)
+
+
+class RouteRequest:
+    '''What one route needs from the event, plus the arguments its prepare step parsed'''
+    
+    __slots__ = ('event', 'room_id', 'claims', 'args')
+    
+    def __init__(self, event: Dict[str, Any], room_id: str, claims: Optional[Dict[str, Any]]):
+        self.event = event
+        self.room_id = room_id
+        self.claims = claims
+        self.args: Dict[str, Any] = {}
+    
+    @property
+    def query(self) -> Dict[str, str]:
+        return self.event.get('queryStringParameters', {}) or {}
+    
+    def json_body(self) -> Optional[Dict[str, Any]]:
+        try:
+            body = json.loads(self.event.get('body') or '{}')
+        except ValueError:
+            return None
+        return body if isinstance(body, dict) else None
+
+
+class Route:
+    '''run gets a cursor, or None when not pooled; prepare runs before a connection is taken and may answer on its own'''
+    
+    __slots__ = ('run', 'auth', 'prepare', 'pooled')
+    
+    def __init__(self, run: Callable[[RouteRequest, Any], Dict[str, Any]], auth: bool = False,
+                 prepare: Optional[Callable[[RouteRequest], Optional[Dict[str, Any]]]] = None, pooled: bool = True):
+        self.run = run
+        self.auth = auth
+        self.prepare = prepare
+        self.pooled = pooled
+
+
+def serve_cached_rooms(request: RouteRequest) -> Optional[Dict[str, Any]]:
+    since_version = parse_since_version(request.query)
+    request.args['since_version'] = since_version
+    fresh = get_fresh_rooms_cache()
+    if fresh is not None:
+        if since_version is None:
+            return rooms_list_response(request.event, *fresh)
+        if since_version >= fresh[0]:
+            return rooms_delta_response(fresh[0], [], False)
+    return None
+
+
+def list_rooms(request: RouteRequest, cursor) -> Dict[str, Any]:
+    since_version = request.args['since_version']
+    cursor.execute('SELECT version FROM rooms_version')
+    version = cursor.fetchone()['version']
+    
+    if since_version is not None:
+        changed = []
+        if since_version < version:
+            cursor.execute(
+                'SELECT room_id, name, capacity, current_users as current, version FROM rooms WHERE version > %s ORDER BY version LIMIT %s',
+                (since_version, ROOMS_LIST_LIMIT)
+            )
+            changed = [dict(row) for row in cursor.fetchall()]
+        more = len(changed) == ROOMS_LIST_LIMIT
+        return rooms_delta_response(changed[-1]['version'] if more else version, changed, more)
+    
+    cached = rooms_cache
+    if cached is not None and cached[1] == version:
+        body = cached[2]
+    else:
+        cursor.execute(
+            'SELECT room_id, name, capacity, current_users as current FROM rooms ORDER BY created_at DESC LIMIT %s',
+            (ROOMS_LIST_LIMIT,)
+        )
+        rows = cursor.fetchall()
+        with current_timer().phase('encode'):
+            body = dump_json([dict(row) for row in rows])
+    store_rooms_cache(version, body)
+    
+    return rooms_list_response(request.event, version, body)
+
+
+def get_room(request: RouteRequest, cursor) -> Dict[str, Any]:
+    cursor.execute('SELECT room_id, name, capacity, current_users as current FROM rooms WHERE room_id = %s', (request.room_id,))
+    room = cursor.fetchone()
+    if not room:
+        return error_response(404, 'Room not found')
+    
+    return json_response(200, dump_json(dict(room)))
+
+
+def list_members(request: RouteRequest, cursor) -> Dict[str, Any]:
+    cursor.execute('SELECT user_id FROM room_members WHERE room_id = %s ORDER BY joined_at', (request.room_id,))
+    user_ids = [row['user_id'] for row in cursor.fetchall()]
+    profiles = get_profiles(cursor, user_ids)
+    members = [profiles[user_id] for user_id in user_ids if user_id in profiles]
+    return json_response(200, dump_json(members))
+
+
+def parse_message_page(request: RouteRequest) -> Optional[Dict[str, Any]]:
+    query_params = request.query
+    try:
         limit = int(query_params.get('limit', 30))
-        limit = min(max(1, limit), 30)
-        
+        after_id = int(query_params['after_id']) if query_params.get('after_id') else None
+        before_id = int(query_params['before_id']) if query_params.get('before_id') else None
+    except ValueError:
+        return error_response(400, 'limit, after_id and before_id must be integers')
+    
+    request.args.update(limit=min(max(1, limit), 30), after_id=after_id, before_id=before_id)
+    return None
+
+
+def list_messages(request: RouteRequest, cursor) -> Dict[str, Any]:
+    room_id = request.room_id
+    limit, after_id, before_id = request.args['limit'], request.args['after_id'], request.args['before_id']
+    
+    # Keyset pagination over (room_id, id): after_id returns only newer rows,
+    # before_id pages back through history, neither returns the latest page
+    if after_id is not None:
+        page = 'WHERE room_id = %s AND id > %s ORDER BY id ASC LIMIT %s'
+        page_args = (room_id, after_id, limit)
+    else:
+        page = 'WHERE room_id = %s AND (%s::int IS NULL OR id < %s) ORDER BY id DESC LIMIT %s'
+        page_args = (room_id, before_id, before_id, limit)
+    
+    if SQL_JSON_MESSAGES:
         cursor.execute(
-            '''SELECT id, room_id, user_id, nick, avatar_url, color, text, 
-               to_char(created_at, \'YYYY-MM-DD"T"HH24:MI:SS"Z"\') as created_at
-               FROM messages 
-               WHERE room_id = %s 
-               ORDER BY created_at ASC 
-               LIMIT %s''',
-            (room_id, limit)
+            f'''SELECT COALESCE(json_agg({MESSAGE_JSON} ORDER BY m.id), '[]')::text AS body
+               FROM (SELECT * FROM messages {page}) m
+               LEFT JOIN users u ON u.user_id = m.user_id''',
+            page_args
         )
-        
+        return json_response(200, cursor.fetchone()['body'])
+    
+    cursor.execute(f'SELECT {MESSAGE_COLUMNS} FROM messages {page}', page_args)
+    rows = cursor.fetchall()
+    if after_id is None:
+        rows = rows[::-1]
+    
+    profiles = get_profiles(cursor, [row['user_id'] for row in rows])
+    
+    timer = current_timer()
+    with timer.phase('encode'):
         messages = []
-        for row in cursor.fetchall():
+        for row in rows:
             msg = dict(row)
             messages.append({
                 'id': msg['id'],
                 'room_id': msg['room_id'],
-                'author': {
-                    'user_id': msg['user_id'],
-                    'nick': msg['nick'],
-                    'avatar_url': msg['avatar_url'],
-                    'color': msg['color']
-                },
+                'author': profiles.get(msg['user_id'], {'user_id': msg['user_id']}),
                 'text': msg['text'],
                 'created_at': msg['created_at']
             })
+        body = dump_json(messages)
+    
+    return json_response(200, body)
+
+
+# Room, members and the newest messages for entering a room, built as one JSON document
+# by one statement instead of three requests that each take a pooled connection
+SNAPSHOT_MESSAGES_MAX = 30
+SNAPSHOT_SQL = f'''
+WITH room AS (
+    SELECT room_id, name, capacity, current_users AS current FROM rooms WHERE room_id = %s
+)
+SELECT json_build_object(
+    'room', row_to_json(room),
+    'members', (
+        SELECT COALESCE(json_agg(json_build_object(
+                   'user_id', u.user_id, 'nick', u.nick, 'avatar_url', u.avatar_url, 'color', u.color
+               ) ORDER BY rm.joined_at), '[]')
+        FROM room_members rm JOIN users u ON u.user_id = rm.user_id
+        WHERE rm.room_id = room.room_id
+    ),
+    'messages', (
+        SELECT COALESCE(json_agg({MESSAGE_JSON} ORDER BY m.id), '[]')
+        FROM (SELECT * FROM messages WHERE room_id = room.room_id ORDER BY id DESC LIMIT %s) m
+        LEFT JOIN users u ON u.user_id = m.user_id
+    )
+)::text AS body
+FROM room
+'''
+
+
+def parse_snapshot(request: RouteRequest) -> Optional[Dict[str, Any]]:
+    try:
+        limit = int(request.query.get('limit', SNAPSHOT_MESSAGES_MAX))
+    except ValueError:
+        return error_response(400, 'limit must be an integer')
+    
+    request.args['limit'] = min(max(1, limit), SNAPSHOT_MESSAGES_MAX)
+    return None
+
+
+def get_snapshot(request: RouteRequest, cursor) -> Dict[str, Any]:
+    cursor.execute(SNAPSHOT_SQL, (request.room_id, request.args['limit']))
+    row = cursor.fetchone()
+    if not row:
+        return error_response(404, 'Room not found')
+    
+    return json_response(200, row['body'])
+
+
+def parse_new_room(request: RouteRequest) -> Optional[Dict[str, Any]]:
+    body_data = request.json_body()
+    if body_data is None:
+        return error_response(400, 'Invalid JSON')
+    name = body_data.get('name', '')
+    name = name.strip() if isinstance(name, str) else ''
+    capacity = body_data.get('capacity')
+    
+    if not name or len(name) > 20:
+        return error_response(400, 'Name must be 1-20 characters')
+    
+    if not isinstance(capacity, int) or capacity < 2 or capacity > 20:
+        return error_response(400, 'Capacity must be 2-20')
+    
+    request.args.update(name=name, capacity=capacity)
+    return None
+
+
+def create_room(request: RouteRequest, cursor) -> Dict[str, Any]:
+    name, capacity = request.args['name'], request.args['capacity']
+    room_id = f"r-{int(time.time())}-{''.join(random.choices(string.ascii_lowercase + string.digits, k=6))}"
+    
+    cursor.execute(
+        '''WITH bump AS (UPDATE rooms_version SET version = version + 1 RETURNING version)
+           INSERT INTO rooms (room_id, name, capacity, current_users, version)
+           SELECT %s, %s, %s, 0, version FROM bump''',
+        (room_id, name, capacity)
+    )
+    
+    invalidate_rooms_cache()
+    
+    room = {
+        'room_id': room_id,
+        'name': name,
+        'capacity': capacity,
+        'current': 0
+    }
+    
+    return json_response(200, dump_json(room))
+
+
+def join_room(request: RouteRequest, cursor) -> Dict[str, Any]:
+    # Who joins comes from the token; the profile is stored once, in users
+    user_id = request.claims['user_id']
+    
+    try:
+        cursor.execute(JOIN_ROOM_SQL, {'room_id': request.room_id, 'user_id': user_id})
+        result = cursor.fetchone()
+    except psycopg2.IntegrityError:
+        # A concurrent join by the same user won the race on the membership key
+        result = {'room_id': None, 'room_exists': True, 'already_member': True}
+    
+    if result['room_id'] is None:
+        if not result['room_exists']:
+            return error_response(404, 'Room not found')
         
-        cursor.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-            'body': json.dumps(messages)
-        }
-    
-    if method == 'POST' and not room_id:
-        body_data = json.loads(event.get('body', '{}'))
-        name = body_data.get('name', '').strip()
-        capacity = body_data.get('capacity')
-        
-        if not name or len(name) < 1 or len(name) > 20:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'Name must be 1-20 characters'})
-            }
-        
-        if not isinstance(capacity, int) or capacity < 2 or capacity > 20:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'Capacity must be 2-20'})
-            }
-        
-        room_id = f"r-{int(time.time())}-{''.join(random.choices(string.ascii_lowercase + string.digits, k=6))}"
-        
-        cursor.execute(
-            "INSERT INTO rooms (room_id, name, capacity, current_users) VALUES (%s, %s, %s, 0)",
-            (room_id, name, capacity)
-        )
-        
-        room = {
-            'room_id': room_id,
-            'name': name,
-            'capacity': capacity,
-            'current': 0
-        }
-        
-        cursor.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-            'body': json.dumps(room)
-        }
-    
-    if method == 'POST' and room_id and action == 'join':
-        body_data = json.loads(event.get('body', '{}'))
-        user_id = body_data.get('user_id', '')
-        nick = body_data.get('nick', '')
-        avatar_url = body_data.get('avatar_url', '')
-        color = body_data.get('color', '')
-        
-        if not all([user_id, nick, avatar_url, color]):
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'Missing user data'})
-            }
-        
-        cursor.execute('SELECT capacity, current_users FROM rooms WHERE room_id = %s', (room_id,))
-        room = cursor.fetchone()
-        
-        if not room:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'Room not found'})
-            }
-        
-        cursor.execute('SELECT 1 FROM room_members WHERE room_id = %s AND user_id = %s', (room_id, user_id))
-        if cursor.fetchone():
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 409,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'already_in_room'})
-            }
-        
-        if room['current_users'] >= room['capacity']:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 409,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'room_full'})
-            }
-        
-        cursor.execute(
-            'INSERT INTO room_members (room_id, user_id, nick, avatar_url, color) VALUES (%s, %s, %s, %s, %s)',
-            (room_id, user_id, nick, avatar_url, color)
-        )
-        
-        cursor.execute('UPDATE rooms SET current_users = current_users + 1 WHERE room_id = %s', (room_id,))
-        
-        cursor.execute('SELECT room_id, name, capacity, current_users as current FROM rooms WHERE room_id = %s', (room_id,))
-        updated_room = dict(cursor.fetchone())
-        
-        cursor.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-            'body': json.dumps(updated_room)
-        }
-    
-    if method == 'POST' and room_id and action == 'leave':
-        body_data = json.loads(event.get('body', '{}'))
-        user_id = body_data.get('user_id', '')
-        
-        if not user_id:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'user_id required'})
-            }
-        
-        cursor.execute('SELECT 1 FROM room_members WHERE room_id = %s AND user_id = %s', (room_id, user_id))
-        if not cursor.fetchone():
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'Not in room'})
-            }
-        
-        cursor.execute('DELETE FROM room_members WHERE room_id = %s AND user_id = %s', (room_id, user_id))
-        cursor.execute('UPDATE rooms SET current_users = GREATEST(0, current_users - 1) WHERE room_id = %s', (room_id,))
-        
-        cursor.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-            'body': json.dumps({'ok': True})
-        }
-    
-    if method == 'POST' and room_id and action == 'messages':
-        body_data = json.loads(event.get('body', '{}'))
-        text = body_data.get('text', '').strip()
-        user_id = body_data.get('user_id', '')
-        nick = body_data.get('nick', '')
-        avatar_url = body_data.get('avatar_url', '')
-        color = body_data.get('color', '')
-        
-        if not text:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'empty'})
-            }
-        
-        if len(text) > 150:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'too_long'})
-            }
-        
-        if not all([user_id, nick, avatar_url, color]):
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-                'body': json.dumps({'error': 'Missing user data'})
-            }
-        
-        cursor.execute(
-            '''INSERT INTO messages (room_id, user_id, nick, avatar_url, color, text) 
-               VALUES (%s, %s, %s, %s, %s, %s) 
-               RETURNING id, room_id, user_id, nick, avatar_url, color, text, 
-               to_char(created_at, \'YYYY-MM-DD"T"HH24:MI:SS"Z"\') as created_at''',
-            (room_id, user_id, nick, avatar_url, color, text)
-        )
-        
-        row = cursor.fetchone()
-        msg = dict(row)
-        
-        message = {
-            'id': msg['id'],
-            'room_id': msg['room_id'],
-            'author': {
-                'user_id': msg['user_id'],
-                'nick': msg['nick'],
-                'avatar_url': msg['avatar_url'],
-                'color': msg['color']
-            },
-            'text': msg['text'],
-            'created_at': msg['created_at']
-        }
-        
-        cursor.close()
-        conn.close()
-        
-        # Broadcast to WebSocket server
-        ws_url = 'https://functions.poehali.dev/7656a328-0a04-4d38-bbeb-761617c1247e'
-        try:
-            broadcast_data = json.dumps({'room_id': room_id, 'message': message}).encode('utf-8')
-            req = urllib.request.Request(ws_url, data=broadcast_data, headers={'Content-Type': 'application/json'}, method='POST')
-            urllib.request.urlopen(req, timeout=1)
-        except Exception:
-            pass  # Ignore broadcast errors
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-            'body': json.dumps({'message': message})
-        }
+        return error_response(409, 'already_in_room' if result['already_member'] else 'room_full')
     
-    cursor.close()
-    conn.close()
+    invalidate_rooms_cache()
     
-    return {
-        'statusCode': 405,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Credentials': 'true'},
-        'body': json.dumps({'error': 'Method not allowed'})
-    }
\ No newline at end of file
+    updated_room = {
+        'room_id': result['room_id'],
+        'name': result['name'],
+        'capacity': result['capacity'],
+        'current': result['current']
+    }
+    
+    return json_response(200, dump_json(updated_room))
+
+
+def leave_room(request: RouteRequest, cursor) -> Dict[str, Any]:
+    cursor.execute(LEAVE_ROOM_SQL, {'room_id': request.room_id, 'user_id': request.claims['user_id']})
+    if not cursor.fetchone()['removed']:
+        return error_response(404, 'Not in room')
+    
+    invalidate_rooms_cache()
+    
+    return json_response(200, OK_BODY)
+
+
+def parse_message_text(request: RouteRequest) -> Optional[Dict[str, Any]]:
+    body_data = request.json_body()
+    if body_data is None:
+        return error_response(400, 'Invalid JSON')
+    text = body_data.get('text', '')
+    text = text.strip() if isinstance(text, str) else ''
+    
+    if not text:
+        return error_response(400, 'empty')
+    
+    if len(text) > 150:
+        return error_response(400, 'too_long')
+    
+    request.args['text'] = text
+    return None
+
+
+def limit_send(request: RouteRequest) -> Optional[Dict[str, Any]]:
+    response = parse_message_text(request)
+    if response is not None:
+        return response
+    
+    user_id = request.claims['user_id']
+    wait = user_send_buckets.take(user_id)
+    if not wait:
+        wait = room_send_buckets.take(request.room_id)
+        if wait:
+            # The room is what refused; the user keeps the token for when it frees up
+            user_send_buckets.refund(user_id)
+    return rate_limited_response(wait) if wait else None
+
+
+def send_message(request: RouteRequest, cursor) -> Dict[str, Any]:
+    # Connectionless route: the batch writer takes the one connection its batch needs
+    message_json = message_batcher.send(PendingMessage(request.room_id, request.claims['user_id'], request.args['text']))
+    if message_json is None:
+        return error_response(403, 'Unknown user')
+    maybe_start_maintenance()
+    
+    return json_response(200, f'{{"message": {message_json}}}')
+
+
+# (method, has room_id, action) -> route; anything else is a 405 before the pool is touched
+ROUTES: Dict[Tuple[str, bool, str], Route] = {
+    ('GET', False, ''): Route(list_rooms, prepare=serve_cached_rooms),
+    ('GET', True, ''): Route(get_room),
+    ('GET', True, 'members'): Route(list_members, auth=True),
+    ('GET', True, 'messages'): Route(list_messages, auth=True, prepare=parse_message_page),
+    ('GET', True, 'snapshot'): Route(get_snapshot, auth=True, prepare=parse_snapshot),
+    ('POST', False, ''): Route(create_room, prepare=parse_new_room),
+    ('POST', True, 'join'): Route(join_room, auth=True),
+    ('POST', True, 'leave'): Route(leave_room, auth=True),
+    ('POST', True, 'messages'): Route(send_message, auth=True, prepare=limit_send, pooled=False),
+    ('POST', True, 'send'): Route(send_message, auth=True, prepare=limit_send, pooled=False)
+}
+
+
+def handle_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+    query_params = event.get('queryStringParameters', {}) or {}
+    room_id = query_params.get('room_id', '')
+    route = ROUTES.get((method, bool(room_id), query_params.get('action', '')))
+    if route is None:
+        return error_response(405, 'Method not allowed')
+    
+    claims = None
+    if route.auth:
+        headers = event.get('headers', {}) or {}
+        auth_header = headers.get('authorization', headers.get('Authorization', ''))
+        token = auth_header[7:] if auth_header.startswith('Bearer ') else auth_header
+        claims = verify_token(token)
+        if claims is None:
+            return error_response(401, 'Unauthorized - token required')
+    
+    request = RouteRequest(event, room_id, claims)
+    if route.prepare is not None:
+        response = route.prepare(request)
+        if response is not None:
+            return response
+    
+    if not os.environ.get('DATABASE_URL'):
+        return error_response(500, 'DATABASE_URL not configured')
+    if not route.pooled:
+        return route.run(request, None)
+    
+    timer = current_timer()
+    with timer.phase('db_acquire'):
+        conn = db_pool.acquire()
+    cursor = conn.cursor()
+    broken = False
+    try:
+        return route.run(request, cursor)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        cursor.close()
+        with timer.phase('db_release'):
+            db_pool.release(conn, discard=broken)
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method = event.get('httpMethod')
+    # Preflights are answered before metrics, routing or anything that could need the database
+    if method == 'OPTIONS':
+        return {'statusCode': 204, 'headers': OPTIONS_HEADERS, 'body': ''}
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get('action') == 'metrics':
+        return metrics_response(event)
+    
+    route = route_label(event)
+    timer = start_request_timer()
+    try:
+        response = handle_request(event, context)
+    except Exception:
+        finish_request_timer(timer, route, {'statusCode': 500})
+        raise
+    return finish_request_timer(timer, route, response)
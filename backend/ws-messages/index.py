@@ -1,129 +1,810 @@
 '''
 Business: WebSocket emulation via long-polling for message_new events only
-Args: GET ?token=X&room_id=Y for polling, POST {room_id, message} for broadcast
-Returns: New messages for subscribed room or broadcast confirmation
+Args: GET ?token=X&room_id=Y&since=T|cursor=<last message id>&timeout=S for polling, POST {room_id, message} or a list of them for broadcast (MESSAGE_BUS=http, signed by rooms)
+Returns: New messages for subscribed room (waits up to timeout for them) or broadcast confirmation
 '''
 
+import base64
+import hashlib
+import hmac
 import json
+import logging
+import math
+import os
+import random
+import select
+import threading
 import time
-from typing import Dict, Any, List
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from operator import itemgetter
+from typing import Dict, Any, List, Optional, Tuple
+
+# Optional; responses fall back to the stdlib encoder. It pulls in datetime, uuid and
+# zoneinfo, so it is imported by the first response that encodes anything
+orjson: Any = None  # None until tried, False when it is not installed
+
+# Built once and shared by every response. Nothing mutates them in place:
+# finish_request_timer copies the headers before adding Server-Timing
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Max-Age': '86400'
+}
+METRICS_HEADERS = {'Content-Type': 'text/plain; version=0.0.4', 'Cache-Control': 'no-store'}
+ERROR_BODIES = {error: json.dumps({'error': error}) for error in (
+    'Forbidden', 'Token required', 'room_id required', 'Invalid token',
+    'room_id and message required', 'Method not allowed', 'rate_limited',
+    'DATABASE_URL not configured',
+)}
+
+
+# shared:begin responses, copied from backend/_shared/responses.py.in by scripts/sync_shared.py
+# Relies on imports: json, typing Any/Dict
+# Relies on the function for: JSON_HEADERS, ERROR_BODIES
+def load_orjson() -> None:
+    global orjson
+    try:
+        import orjson
+    except ImportError:
+        orjson = False
+
+
+def dump_json(value: Any) -> str:
+    if orjson is None:
+        load_orjson()
+    if orjson:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value)
+
+
+def json_response(status: int, body: str) -> Dict[str, Any]:
+    return {'statusCode': status, 'headers': JSON_HEADERS, 'body': body}
+
+
+def error_response(status: int, error: str) -> Dict[str, Any]:
+    return json_response(status, ERROR_BODIES.get(error) or json.dumps({'error': error}))
+# shared:end responses
+
 
-# In-memory storage: room_id -> list of messages with timestamps
-room_messages: Dict[str, List[Dict[str, Any]]] = {}
 MAX_MESSAGES_PER_ROOM = 100
 MESSAGE_TTL = 120  # 2 minutes
+ROOM_IDLE_TTL = 600  # drop rooms with no traffic for 10 minutes
+ROOM_SWEEP_INTERVAL = 60
+LONG_POLL_TIMEOUT = float(os.environ.get('LONG_POLL_TIMEOUT', '25'))
+LONG_POLL_MAX_TIMEOUT = 28.0
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+# rooms publishes every send on this channel; each instance LISTENs and fills its own buffers
+MESSAGE_BUS = os.environ.get('MESSAGE_BUS', 'notify')
+MESSAGE_BUS_CHANNEL = 'room_messages'
+BUS_IDLE_CHECK_INTERVAL = 5.0
+BUS_RECONNECT_DELAY = 0.5
+BUS_RECONNECT_DELAY_MAX = 30.0
+MESSAGE_JSON = '''json_build_object(
+                   'id', m.id, 'room_id', m.room_id,
+                   'author', json_build_object('user_id', m.user_id, 'nick', u.nick, 'avatar_url', u.avatar_url, 'color', u.color),
+                   'text', m.text,
+                   'created_at', to_char(m.created_at, \'YYYY-MM-DD"T"HH24:MI:SS"Z"\'))'''
+
+logger = logging.getLogger(__name__)
+
+# psycopg2 adds ~20 ms to a cold start and only the notify bus uses it, so the listener
+# thread imports it; polls and broadcasts never wait for it
+psycopg2: Any = None
+driver_lock = threading.Lock()
+
+
+def load_driver() -> None:
+    global psycopg2
+    if psycopg2 is not None:
+        return
+    with driver_lock:
+        if psycopg2 is None:
+            import psycopg2
+
+# Every room condition shares one lock, so a POST wakes only pollers of its own room
+store_lock = threading.Lock()
+
+
+class RoomBuffer:
+    '''Fixed-capacity ring of (message_id, timestamp, message) entries in messages.id order'''
+    
+    __slots__ = ('capacity', 'entries', 'start', 'count', 'last_timestamp', 'last_message_id', 'last_active', 'waiters', 'cond')
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: List[Optional[Tuple[int, float, Any]]] = [None] * capacity
+        self.start = 0
+        self.count = 0
+        self.last_timestamp = 0.0
+        self.last_message_id = 0  # highest messages.id seen, for gap detection
+        self.last_active = time.monotonic()
+        self.waiters = 0
+        self.cond = threading.Condition(store_lock)
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def __getitem__(self, index: int) -> Tuple[int, float, Any]:
+        return self.entries[(self.start + index) % self.capacity]
+    
+    def append(self, message: Dict[str, Any]) -> None:
+        message_id = message['id']
+        self.last_active = time.monotonic()
+        self.last_message_id = max(self.last_message_id, message_id)
+        if self.count and message_id < self[self.count - 1][0]:
+            self._insert(message_id, message)
+            return
+        # Timestamps never go backwards so both id and timestamp stay bisectable
+        self.last_timestamp = max(time.time(), self.last_timestamp)
+        entry = (message_id, self.last_timestamp, message)
+        if self.count < self.capacity:
+            self.entries[(self.start + self.count) % self.capacity] = entry
+            self.count += 1
+        else:
+            self.entries[self.start] = entry
+            self.start = (self.start + 1) % self.capacity
+    
+    def _insert(self, message_id: int, message: Dict[str, Any]) -> None:
+        # Committed after a message with a higher id: slot it in by id, under its successor's timestamp
+        entries = [self[i] for i in range(self.count)]
+        index = bisect_left(entries, message_id, key=itemgetter(0))
+        if index == 0 and self.count == self.capacity:
+            return  # older than everything a full buffer keeps
+        entries.insert(index, (message_id, entries[index][1], message))
+        entries = entries[-self.capacity:]
+        self.entries = entries + [None] * (self.capacity - len(entries))
+        self.start = 0
+        self.count = len(entries)
+    
+    def has_message(self, message_id: int) -> bool:
+        if message_id > self.last_message_id:
+            return False
+        index = bisect_left(self, message_id, key=itemgetter(0))
+        return index < self.count and self[index][0] == message_id
+    
+    def expire(self, current_time: float) -> None:
+        cutoff = current_time - MESSAGE_TTL
+        while self.count and self.entries[self.start][1] <= cutoff:
+            self.entries[self.start] = None
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+    
+    def read_after(self, cursor: Optional[int], since: float) -> List[Any]:
+        if cursor is not None:
+            index = bisect_right(self, cursor, key=itemgetter(0))
+        else:
+            index = bisect_right(self, since, key=itemgetter(1))
+        return [self[i][2] for i in range(index, self.count)]
+
+
+# In-memory storage: room_id -> ring buffer of recent messages
+room_messages: Dict[str, RoomBuffer] = {}
+last_sweep = time.monotonic()
+
+
+def get_room_buffer(room_id: str) -> RoomBuffer:
+    buffer = room_messages.get(room_id)
+    if buffer is None:
+        buffer = RoomBuffer(MAX_MESSAGES_PER_ROOM)
+        room_messages[room_id] = buffer
+    return buffer
+
+
+def sweep_idle_rooms(now: float) -> None:
+    global last_sweep
+    if now - last_sweep < ROOM_SWEEP_INTERVAL:
+        return
+    last_sweep = now
+    current_time = time.time()
+    for room_id, buffer in list(room_messages.items()):
+        buffer.expire(current_time)
+        if not buffer.count and not buffer.waiters and now - buffer.last_active > ROOM_IDLE_TTL:
+            del room_messages[room_id]
+
+
+def collect_new_messages(buffer: RoomBuffer, cursor: Optional[int], since: float) -> List[Dict[str, Any]]:
+    buffer.expire(time.time())
+    return [{'type': 'message_new', 'message': message} for message in buffer.read_after(cursor, since)]
+
+
+def append_new(buffer: RoomBuffer, message: Dict[str, Any]) -> bool:
+    # The same message can arrive over the bus, a backfill and a direct POST
+    if buffer.has_message(message['id']):
+        return False
+    buffer.append(message)
+    return True
+
+
+class MessageBusListener:
+    '''Background LISTEN connection that fans room_messages notifications into the local buffers'''
+    
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.stats = {'received': 0, 'duplicates': 0, 'gaps': 0, 'backfilled': 0, 'reconnects': 0}
+        self._reported_unconfigured = False
+    
+    def ensure_started(self) -> bool:
+        '''Starts the listener if it is not running; False when the notify bus has no database to listen on'''
+        if MESSAGE_BUS != 'notify':
+            return True
+        if not os.environ.get('DATABASE_URL'):
+            if not self._reported_unconfigured:
+                self._reported_unconfigured = True
+                logger.error('MESSAGE_BUS=notify needs DATABASE_URL: without it no sent message ever reaches this instance')
+            return False
+        if self._thread is not None and self._thread.is_alive():
+            return True
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='message-bus', daemon=True)
+                self._thread.start()
+        return True
+    
+    def _run(self) -> None:
+        load_driver()
+        delay = BUS_RECONNECT_DELAY
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {MESSAGE_BUS_CHANNEL}')
+                # Anything published while we were not listening is in the table already
+                self._catch_up(conn)
+                delay = BUS_RECONNECT_DELAY
+                self._listen(conn)
+            except (psycopg2.Error, OSError) as error:
+                logger.warning('message bus connection lost: %s', error)
+            finally:
+                if conn is not None:
+                    conn.close()
+            self.stats['reconnects'] += 1
+            time.sleep(delay)
+            delay = min(delay * 2, BUS_RECONNECT_DELAY_MAX)
+    
+    def _listen(self, conn) -> None:
+        while True:
+            if select.select([conn], [], [], BUS_IDLE_CHECK_INTERVAL) == ([], [], []):
+                # Quiet channel: make sure the connection is still there
+                # Notifications that arrive during the query land in conn.notifies, so drain them below
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            conn.poll()
+            payloads = [notify.payload for notify in conn.notifies]
+            del conn.notifies[:]
+            if payloads:
+                self._dispatch(conn, payloads)
+    
+    def _catch_up(self, conn) -> None:
+        with store_lock:
+            ranges = {room_id: (buffer.last_message_id, None) for room_id, buffer in room_messages.items() if buffer.last_message_id}
+        if ranges:
+            self._deliver(self._load(conn, ranges))
+    
+    def _dispatch(self, conn, payloads: List[str]) -> None:
+        events = []
+        for payload in payloads:
+            try:
+                event = json.loads(payload)
+            except ValueError:
+                continue
+            if isinstance(event, dict) and event.get('room_id') and isinstance(event.get('id'), int):
+                events.append(event)
+        self.stats['received'] += len(events)
+        
+        with store_lock:
+            known = {event['room_id']: room_messages[event['room_id']].last_message_id for event in events if event['room_id'] in room_messages}
+        
+        # room_id -> (after_id, through_id) still to be read from the messages table
+        missing: Dict[str, Tuple[int, Optional[int]]] = {}
+        
+        def need(room_id: str, after_id: int, through_id: int) -> None:
+            if room_id in missing:
+                after_id = min(after_id, missing[room_id][0])
+                through_id = max(through_id, missing[room_id][1])
+            missing[room_id] = (after_id, through_id)
+        
+        for event in events:
+            room_id = event['room_id']
+            last_id = known.get(room_id, 0)
+            prev_id = event.get('prev_id')
+            if last_id and isinstance(prev_id, int) and prev_id > last_id:
+                self.stats['gaps'] += 1
+                need(room_id, last_id, prev_id)
+            if not isinstance(event.get('message'), dict):
+                need(room_id, event['id'] - 1, event['id'])
+            known[room_id] = max(last_id, event['id'])
+        
+        messages = self._load(conn, missing) if missing else []
+        messages.extend((event['room_id'], event['message']) for event in events if isinstance(event.get('message'), dict))
+        self._deliver(messages)
+    
+    def _load(self, conn, ranges: Dict[str, Tuple[int, Optional[int]]]) -> List[Tuple[str, Dict[str, Any]]]:
+        room_ids = list(ranges)
+        with conn.cursor() as cursor:
+            # Buffers drop messages older than MESSAGE_TTL, so there is no point reading further back
+            cursor.execute(
+                f'''SELECT m.room_id, {MESSAGE_JSON}::text
+                   FROM messages m
+                   LEFT JOIN users u ON u.user_id = m.user_id
+                   JOIN unnest(%s::text[], %s::int[], %s::int[]) AS r(room_id, after_id, through_id)
+                     ON m.room_id = r.room_id AND m.id > r.after_id AND (r.through_id IS NULL OR m.id <= r.through_id)
+                   WHERE m.created_at >= CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+                   ORDER BY m.id''',
+                (room_ids, [ranges[r][0] for r in room_ids], [ranges[r][1] for r in room_ids], MESSAGE_TTL)
+            )
+            rows = cursor.fetchall()
+        self.stats['backfilled'] += len(rows)
+        return [(room_id, json.loads(message)) for room_id, message in rows]
+    
+    def _deliver(self, messages: List[Tuple[str, Dict[str, Any]]]) -> None:
+        if not messages:
+            return
+        # Commit order can differ from id order; appending by id keeps each room in send order
+        messages.sort(key=lambda item: item[1].get('id', 0))
+        with store_lock:
+            touched = {}
+            for room_id, message in messages:
+                buffer = get_room_buffer(room_id)
+                if append_new(buffer, message):
+                    touched[room_id] = buffer
+                else:
+                    self.stats['duplicates'] += 1
+            for buffer in touched.values():
+                buffer.cond.notify_all()
+
+
+bus_listener = MessageBusListener()
+
+
+# shared:begin metrics, copied from backend/_shared/metrics.py.in by scripts/sync_shared.py
+# Relies on imports: hmac, os, random, threading, time, bisect_left, typing Any/Dict/List/Tuple
+# Relies on the function for: METRICS_HEADERS, error_response (responses block), metrics = Metrics('<function>'), metrics_gauges()
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.05'))  # share of requests timed phase by phase
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # GET ?action=metrics needs a matching X-Metrics-Token; unset, there is no metrics endpoint
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+
+class RequestTimer:
+    '''Phase timings and row count of one sampled request'''
+    
+    sampled = True
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self.rows = 0
+    
+    def phase(self, name: str) -> 'TimedPhase':
+        return TimedPhase(self, name)
+    
+    def add(self, name: str, duration: float, rows: int = 0) -> None:
+        self.phases.append((name, duration))
+        self.rows += rows
+
+
+class TimedPhase:
+    __slots__ = ('timer', 'name', 'started')
+    
+    def __init__(self, timer: RequestTimer, name: str):
+        self.timer = timer
+        self.name = name
+        self.started = 0.0
+    
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+    
+    def __exit__(self, *exc_info) -> None:
+        self.timer.add(self.name, time.perf_counter() - self.started)
+
+
+class NoopTimer:
+    '''Stands in for RequestTimer on requests that are not sampled, so timing calls cost next to nothing'''
+    
+    sampled = False
+    
+    def phase(self, name: str) -> 'NoopTimer':
+        return self
+    
+    def add(self, name: str, duration: float, rows: int = 0) -> None:
+        pass
+    
+    def __enter__(self) -> None:
+        pass
+    
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+NOOP_TIMER = NoopTimer()
+timer_local = threading.local()
+
+
+def current_timer():
+    return getattr(timer_local, 'timer', NOOP_TIMER)
+
+
+class Metrics:
+    '''Process-wide request counters and sampled phase histograms, rendered in Prometheus text format'''
+    
+    def __init__(self, function: str):
+        self.function = function
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, int], int] = {}
+        self.phases: Dict[Tuple[str, str], List[float]] = {}  # bucket counts, then count and sum
+        self.rows: Dict[str, int] = {}
+        self.response_bytes: Dict[str, int] = {}
+    
+    def _observe(self, route: str, phase: str, duration: float) -> None:
+        histogram = self.phases.get((route, phase))
+        if histogram is None:
+            histogram = [0] * (len(METRICS_BUCKETS) + 3)
+            self.phases[(route, phase)] = histogram
+        histogram[bisect_left(METRICS_BUCKETS, duration)] += 1
+        histogram[-2] += 1
+        histogram[-1] += duration
+    
+    def observe(self, route: str, phase: str, duration: float) -> None:
+        with self._lock:
+            self._observe(route, phase, duration)
+    
+    def record(self, route: str, status: int, timer, total: float, body_bytes: int) -> None:
+        with self._lock:
+            self.requests[(route, status)] = self.requests.get((route, status), 0) + 1
+            if not timer.sampled:
+                return
+            self._observe(route, 'total', total)
+            for phase, duration in timer.phases:
+                self._observe(route, phase, duration)
+            self.rows[route] = self.rows.get(route, 0) + timer.rows
+            self.response_bytes[route] = self.response_bytes.get(route, 0) + body_bytes
+    
+    def render(self, gauges: Dict[str, float]) -> str:
+        fn = self.function
+        lines = ['# TYPE handler_requests_total counter']
+        with self._lock:
+            for (route, status), count in sorted(self.requests.items()):
+                lines.append(f'handler_requests_total{{function="{fn}",route="{route}",status="{status}"}} {count}')
+            lines.append('# TYPE handler_phase_seconds histogram')
+            for (route, phase), histogram in sorted(self.phases.items()):
+                labels = f'function="{fn}",route="{route}",phase="{phase}"'
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS, histogram):
+                    cumulative += count
+                    lines.append(f'handler_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'handler_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram[-2]}')
+                lines.append(f'handler_phase_seconds_count{{{labels}}} {histogram[-2]}')
+                lines.append(f'handler_phase_seconds_sum{{{labels}}} {histogram[-1]:.6f}')
+            lines.append('# TYPE handler_sampled_rows_total counter')
+            for route, rows in sorted(self.rows.items()):
+                lines.append(f'handler_sampled_rows_total{{function="{fn}",route="{route}"}} {rows}')
+            lines.append('# TYPE handler_sampled_response_bytes_total counter')
+            for route, size in sorted(self.response_bytes.items()):
+                lines.append(f'handler_sampled_response_bytes_total{{function="{fn}",route="{route}"}} {size}')
+        for name, value in gauges.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{{function="{fn}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def start_request_timer():
+    timer = RequestTimer() if random.random() < METRICS_SAMPLE_RATE else NOOP_TIMER
+    timer_local.timer = timer
+    return timer
+
+
+def finish_request_timer(timer, route: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    timer_local.timer = NOOP_TIMER
+    status = response.get('statusCode', 200)
+    if not timer.sampled:
+        metrics.record(route, status, timer, 0.0, 0)
+        return response
+    
+    total = time.perf_counter() - timer.started
+    metrics.record(route, status, timer, total, len((response.get('body') or '').encode('utf-8')))
+    server_timing = [f'{name};dur={duration * 1000:.2f}' for name, duration in timer.phases]
+    server_timing.append(f'total;dur={total * 1000:.2f}')
+    response['headers'] = dict(response.get('headers') or {}, **{
+        'Server-Timing': ', '.join(server_timing),
+        'Timing-Allow-Origin': '*'
+    })
+    return response
+
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    headers = event.get('headers', {}) or {}
+    supplied = headers.get('X-Metrics-Token') or headers.get('x-metrics-token') or ''
+    if not METRICS_TOKEN:
+        # Pool, cache and bus internals stay private unless a scraper is configured
+        return error_response(404, 'Not found')
+    if not hmac.compare_digest(supplied.encode('utf-8'), METRICS_TOKEN.encode('utf-8')):
+        return error_response(403, 'Forbidden')
+    return {
+        'statusCode': 200,
+        'headers': METRICS_HEADERS,
+        'body': metrics.render(metrics_gauges())
+    }
+# shared:end metrics
+
+
+metrics = Metrics('ws-messages')
+
+
+def route_label(event: Dict[str, Any]) -> str:
+    return event.get('httpMethod', 'GET')
+
+
+def metrics_gauges() -> Dict[str, float]:
+    gauges = {f'bus_{name}': value for name, value in bus_listener.stats.items()}
+    gauges['rooms_buffered'] = len(room_messages)
+    gauges.update({f'broadcast_limit_{name}': value for name, value in room_broadcast_buckets.stats.items()})
+    return gauges
+
+
+# shared:begin tokens, copied from backend/_shared/tokens.py.in by scripts/sync_shared.py
+# Relies on imports: base64, hashlib, hmac, json, os, threading, time, OrderedDict, typing Any/Dict/Optional
+TOKEN_SECRET = os.environ.get('TOKEN_SECRET', '')  # shared with auth, which signs the tokens
+TOKEN_CACHE_SIZE = 4096  # recently verified tokens kept to skip the HMAC on every poll
+
+token_cache_lock = threading.Lock()
+token_cache: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+
+
+def decode_token_segment(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def verify_token(token: Optional[str]) -> Optional[Dict[str, Any]]:
+    '''Claims ({user_id, nick, color, exp}) of an unexpired token signed by auth, else None'''
+    if not token or not TOKEN_SECRET:
+        return None
+    
+    with token_cache_lock:
+        claims = token_cache.get(token)
+        if claims is not None:
+            token_cache.move_to_end(token)
+    
+    if claims is None:
+        version, _, rest = token.partition('.')
+        payload, _, signature = rest.partition('.')
+        if version != 'v1' or not payload or not signature:
+            return None
+        expected = hmac.new(TOKEN_SECRET.encode('utf-8'), f'v1.{payload}'.encode('utf-8'), hashlib.sha256).digest()
+        try:
+            if not hmac.compare_digest(decode_token_segment(signature), expected):
+                return None
+            claims = json.loads(decode_token_segment(payload))
+        except ValueError:
+            return None
+        if not isinstance(claims, dict) or not isinstance(claims.get('exp'), int) or not claims.get('user_id'):
+            return None
+        with token_cache_lock:
+            token_cache[token] = claims
+            if len(token_cache) > TOKEN_CACHE_SIZE:
+                token_cache.popitem(last=False)
+    
+    if claims['exp'] <= time.time():
+        return None
+    return claims
+# shared:end tokens
+
+
+BROADCAST_SIGNATURE_TTL = int(os.environ.get('BROADCAST_SIGNATURE_TTL', '60'))  # a signed broadcast is refused this many seconds after rooms signed it
+
+
+def verify_broadcast_signature(headers: Dict[str, str], body: str) -> bool:
+    '''X-Broadcast-Signature is t=<unix time>,v1=<hex HMAC-SHA256 of "<t>.<body>" under TOKEN_SECRET>'''
+    header = headers.get('X-Broadcast-Signature') or headers.get('x-broadcast-signature') or ''
+    fields = dict(part.strip().split('=', 1) for part in header.split(',') if '=' in part)
+    try:
+        signed_at = int(fields.get('t', ''))
+    except ValueError:
+        return False
+    if not TOKEN_SECRET or abs(time.time() - signed_at) > BROADCAST_SIGNATURE_TTL:
+        return False
+    expected = hmac.new(TOKEN_SECRET.encode('utf-8'), f'{signed_at}.{body}'.encode('utf-8'), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(fields.get('v1', ''), expected)
+
+
+# Signatures only prove a POST came from a rooms instance, so the buffers are still guarded
+# per room. The budget sits above what rooms lets one room send, so only a runaway sender gets shed
+BROADCAST_ROOM_RATE = float(os.environ.get('BROADCAST_ROOM_RATE', '20'))  # messages per second per room, 0 disables
+BROADCAST_ROOM_BURST = float(os.environ.get('BROADCAST_ROOM_BURST', '40'))
+RATE_LIMIT_KEYS = 10000  # buckets kept; the least recently used go first
+# shared:begin rate_limit, copied from backend/_shared/rate_limit.py.in by scripts/sync_shared.py
+# Relies on imports: math, threading, time, OrderedDict, typing Any/Dict
+# Relies on the function for: JSON_HEADERS, ERROR_BODIES with 'rate_limited'
+RATE_LIMITED_HEADERS = dict(JSON_HEADERS, **{'Access-Control-Expose-Headers': 'Retry-After'})
+
+
+class TokenBuckets:
+    '''One token bucket per key, refilled lazily when the key is next used'''
+    
+    def __init__(self, rate: float, burst: float, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets: 'OrderedDict[str, List[float]]' = OrderedDict()  # key -> [tokens, refilled_at]
+        self.stats = {'limited': 0, 'evicted': 0}
+    
+    def take(self, key: str, cost: float = 1.0) -> float:
+        '''0 when the tokens were taken, else the seconds until they will be there'''
+        if self.rate <= 0:
+            return 0.0
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+                    self.stats['evicted'] += 1
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            self.stats['limited'] += 1
+            return (cost - bucket[0]) / self.rate
+    
+    def refund(self, key: str, cost: float = 1.0) -> None:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + cost)
+
+
+def rate_limited_response(wait: float) -> Dict[str, Any]:
+    headers = dict(RATE_LIMITED_HEADERS, **{'Retry-After': str(max(1, math.ceil(wait)))})
+    return {'statusCode': 429, 'headers': headers, 'body': ERROR_BODIES['rate_limited']}
+# shared:end rate_limit
+
+
+room_broadcast_buckets = TokenBuckets(BROADCAST_ROOM_RATE, BROADCAST_ROOM_BURST, RATE_LIMIT_KEYS)
+
+
+def handle_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    # Long-polling: GET ?token=X&room_id=Y&since=timestamp
+    # Long-polling: GET ?token=X&room_id=Y&since=timestamp&timeout=seconds
     if method == 'GET':
-        params = event.get('queryStringParameters', {})
+        if not bus_listener.ensure_started():
+            # Polls would only ever time out empty
+            return error_response(500, 'DATABASE_URL not configured')
+        
+        params = event.get('queryStringParameters', {}) or {}
         token = params.get('token')
         room_id = params.get('room_id')
         since_str = params.get('since', '0')
+        cursor_str = params.get('cursor')
         
         if not token:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Token required'})
-            }
+            return error_response(401, 'Token required')
         
         if not room_id:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'room_id required'})
-            }
-        
-        # Basic token validation
-        if len(token) < 10:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid token'})
-            }
+            return error_response(400, 'room_id required')
+        
+        if verify_token(token) is None:
+            return error_response(401, 'Invalid token')
         
         try:
             since = float(since_str)
         except ValueError:
             since = 0
         
-        # Clean old messages
-        current_time = time.time()
-        if room_id in room_messages:
-            room_messages[room_id] = [
-                msg for msg in room_messages[room_id]
-                if current_time - msg['timestamp'] < MESSAGE_TTL
-            ]
-        
-        # Get new messages
-        new_messages = []
-        if room_id in room_messages:
-            new_messages = [
-                {'type': 'message_new', 'message': msg['data']}
-                for msg in room_messages[room_id]
-                if msg['timestamp'] > since
-            ]
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({
+        try:
+            cursor = int(cursor_str) if cursor_str else None
+        except ValueError:
+            cursor = None
+        
+        try:
+            wait = float(params.get('timeout', LONG_POLL_TIMEOUT))
+        except ValueError:
+            wait = LONG_POLL_TIMEOUT
+        wait = min(max(0.0, wait), LONG_POLL_MAX_TIMEOUT)
+        deadline = time.monotonic() + wait
+        timer = current_timer()
+        
+        # Park until a broadcast for this room wakes us or the timeout expires
+        with timer.phase('wait'), store_lock:
+            sweep_idle_rooms(time.monotonic())
+            buffer = get_room_buffer(room_id)
+            buffer.last_active = time.monotonic()
+            new_messages = collect_new_messages(buffer, cursor, since)
+            buffer.waiters += 1
+            try:
+                while not new_messages:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    buffer.cond.wait(remaining)
+                    new_messages = collect_new_messages(buffer, cursor, since)
+            finally:
+                buffer.waiters -= 1
+            current_time = time.time()
+            # messages.id, so the next poll can land on any instance
+            if new_messages:
+                next_cursor = new_messages[-1]['message']['id']
+            else:
+                next_cursor = cursor if cursor is not None else buffer.last_message_id
+        
+        with timer.phase('encode'):
+            body = dump_json({
                 'messages': new_messages,
-                'timestamp': current_time
+                'timestamp': current_time,
+                'cursor': next_cursor
             })
-        }
+        
+        return json_response(200, body)
     
-    # Broadcast: POST {room_id, message}
+    # Broadcast: POST {room_id, message} or a batched [{room_id, message}, ...]
     if method == 'POST':
-        body_data = json.loads(event.get('body', '{}'))
-        room_id = body_data.get('room_id')
-        message = body_data.get('message')
-        
-        if not room_id or not message:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'room_id and message required'})
-            }
-        
-        # Store message with timestamp
-        if room_id not in room_messages:
-            room_messages[room_id] = []
-        
-        room_messages[room_id].append({
-            'timestamp': time.time(),
-            'data': message
-        })
-        
-        # Keep only recent messages
-        if len(room_messages[room_id]) > MAX_MESSAGES_PER_ROOM:
-            room_messages[room_id] = room_messages[room_id][-MAX_MESSAGES_PER_ROOM:]
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'status': 'broadcasted'})
-        }
+        # Only the http bus delivers by POST, and only rooms may: anyone else could put words in any room
+        if MESSAGE_BUS != 'http':
+            return error_response(405, 'Method not allowed')
+        body = event.get('body') or ''
+        if not verify_broadcast_signature(event.get('headers', {}) or {}, body):
+            return error_response(403, 'Forbidden')
+        
+        body_data = json.loads(body or '{}')
+        items = body_data if isinstance(body_data, list) else [body_data]
+        
+        # Buffers are ordered by messages.id, so every message needs its integer id
+        if not items or not all(
+            isinstance(item, dict) and item.get('room_id') and isinstance(item.get('message'), dict)
+            and isinstance(item['message'].get('id'), int) for item in items
+        ):
+            return error_response(400, 'room_id and message required')
+        
+        per_room: Dict[str, int] = {}
+        for item in items:
+            per_room[item['room_id']] = per_room.get(item['room_id'], 0) + 1
+        waits = {room_id: room_broadcast_buckets.take(room_id, count) for room_id, count in per_room.items()}
+        limited = {room_id for room_id, wait in waits.items() if wait}
+        if limited:
+            if len(limited) == len(per_room):
+                return rate_limited_response(min(waits.values()))
+            # A batch spans rooms; rooms within budget still get their messages
+            items = [item for item in items if item['room_id'] not in limited]
+        
+        with store_lock:
+            sweep_idle_rooms(time.monotonic())
+            touched = {}
+            for item in items:
+                buffer = get_room_buffer(item['room_id'])
+                if append_new(buffer, item['message']):
+                    touched[item['room_id']] = buffer
+            for buffer in touched.values():
+                buffer.cond.notify_all()
+        
+        return json_response(200, dump_json({'status': 'broadcasted', 'count': len(items), 'limited': len(limited)}))
     
-    return {
-        'statusCode': 405,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Method not allowed'})
-    }
+    return error_response(405, 'Method not allowed')
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method = event.get('httpMethod')
+    # Preflights are answered before metrics, routing or anything that could need the database
+    if method == 'OPTIONS':
+        return {'statusCode': 200, 'headers': OPTIONS_HEADERS, 'body': ''}
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get('action') == 'metrics':
+        return metrics_response(event)
+    
+    route = route_label(event)
+    timer = start_request_timer()
+    try:
+        response = handle_request(event, context)
+    except Exception:
+        finish_request_timer(timer, route, {'statusCode': 500})
+        raise
+    return finish_request_timer(timer, route, response)
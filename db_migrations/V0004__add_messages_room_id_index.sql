@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room_id, id);
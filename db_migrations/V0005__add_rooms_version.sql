@@ -0,0 +1,5 @@
+CREATE SEQUENCE IF NOT EXISTS rooms_version_seq;
+
+ALTER TABLE rooms ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('rooms_version_seq');
+
+CREATE INDEX IF NOT EXISTS idx_rooms_version ON rooms(version);
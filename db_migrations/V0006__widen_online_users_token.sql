@@ -0,0 +1 @@
+ALTER TABLE online_users ALTER COLUMN token TYPE TEXT;
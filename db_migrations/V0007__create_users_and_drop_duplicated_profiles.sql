@@ -0,0 +1,23 @@
+CREATE TABLE IF NOT EXISTS users (
+  user_id VARCHAR(100) PRIMARY KEY,
+  nick VARCHAR(20) NOT NULL,
+  avatar_url TEXT NOT NULL,
+  color VARCHAR(7) NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO users (user_id, nick, avatar_url, color)
+SELECT DISTINCT ON (user_id) user_id, nick, avatar_url, color
+FROM (
+  SELECT user_id, nick, avatar_url, color, last_seen AS seen_at FROM online_users
+  UNION ALL
+  SELECT user_id, nick, avatar_url, color, joined_at FROM room_members
+  UNION ALL
+  SELECT user_id, nick, avatar_url, color, created_at FROM messages
+) AS known
+ORDER BY user_id, seen_at DESC NULLS LAST
+ON CONFLICT (user_id) DO NOTHING;
+
+ALTER TABLE messages DROP COLUMN IF EXISTS nick, DROP COLUMN IF EXISTS avatar_url, DROP COLUMN IF EXISTS color;
+ALTER TABLE room_members DROP COLUMN IF EXISTS nick, DROP COLUMN IF EXISTS avatar_url, DROP COLUMN IF EXISTS color;
+ALTER TABLE online_users DROP COLUMN IF EXISTS nick, DROP COLUMN IF EXISTS avatar_url, DROP COLUMN IF EXISTS color, DROP COLUMN IF EXISTS token;
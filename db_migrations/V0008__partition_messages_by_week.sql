@@ -0,0 +1,33 @@
+ALTER TABLE messages RENAME TO messages_legacy;
+ALTER INDEX IF EXISTS idx_messages_room_id RENAME TO idx_messages_legacy_room_id;
+DROP INDEX IF EXISTS idx_messages_room_created;
+
+UPDATE messages_legacy SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE messages_legacy DROP CONSTRAINT IF EXISTS messages_pkey;
+ALTER TABLE messages_legacy ALTER COLUMN created_at SET NOT NULL;
+ALTER TABLE messages_legacy ALTER COLUMN id DROP DEFAULT;
+ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+
+CREATE TABLE IF NOT EXISTS messages (
+  id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+  room_id VARCHAR(50) NOT NULL,
+  user_id VARCHAR(50) NOT NULL,
+  text VARCHAR(150) NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room_id, id);
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+-- Existing history becomes one partition that ends tomorrow; the rooms
+-- function creates weekly partitions from there on and retires this one
+-- once all of it is older than MESSAGE_RETENTION_DAYS
+DO $$
+BEGIN
+  EXECUTE format(
+    'ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+    (CURRENT_DATE + 1)::timestamp
+  );
+END $$;
@@ -0,0 +1,15 @@
+-- rooms.version came from rooms_version_seq when a statement ran, but statements
+-- commit in any order: a reader could see version N+1 before N committed and never
+-- look below N+1 again. Every write now bumps this single row in the same
+-- statement. Its row lock makes the next writer wait for the commit, so versions
+-- become visible in order and this row holds the version of the whole list.
+CREATE TABLE IF NOT EXISTS rooms_version (
+  id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+  version BIGINT NOT NULL
+);
+
+INSERT INTO rooms_version (id, version)
+SELECT TRUE, GREATEST((SELECT last_value FROM rooms_version_seq), (SELECT COALESCE(max(version), 0) FROM rooms))
+ON CONFLICT (id) DO NOTHING;
+
+ALTER TABLE rooms ALTER COLUMN version DROP DEFAULT;
@@ -0,0 +1,78 @@
+'''
+Business: Exports message partitions the rooms function detached for archiving (MESSAGE_ARCHIVE=1)
+Args: DATABASE_URL env, --out directory, --drop to remove each table once its file is written
+Returns: One gzipped JSON-lines file per messages_archive_* table, authors hydrated from users
+'''
+
+import argparse
+import gzip
+import os
+import sys
+from pathlib import Path
+
+import psycopg2
+from psycopg2 import sql
+
+EXPORT_BATCH_ROWS = 5000
+
+EXPORT_SQL = '''SELECT json_build_object(
+    'id', m.id,
+    'room_id', m.room_id,
+    'user_id', m.user_id,
+    'nick', u.nick,
+    'color', u.color,
+    'text', m.text,
+    'created_at', to_char(m.created_at, 'YYYY-MM-DD"T"HH24:MI:SS')
+)::text
+FROM {} m LEFT JOIN users u ON u.user_id = m.user_id
+ORDER BY m.id'''
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--out', default='messages-archive')
+    parser.add_argument('--drop', action='store_true', help='drop each archive table after exporting it')
+    args = parser.parse_args()
+
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 2
+
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                '''SELECT c.relname FROM pg_class c
+                   WHERE c.relkind = 'r' AND c.relname LIKE 'messages\\_archive\\_%' AND NOT c.relispartition
+                   ORDER BY c.relname'''
+            )
+            tables = [row[0] for row in cursor.fetchall()]
+
+        for table in tables:
+            path = out_dir / f'{table}.jsonl.gz'
+            partial = path.with_suffix('.gz.partial')
+            # A named cursor streams the table in batches instead of loading it whole
+            with conn.cursor(name=f'export_{table}') as cursor, gzip.open(partial, 'wt', encoding='utf-8') as file:
+                cursor.itersize = EXPORT_BATCH_ROWS
+                cursor.execute(sql.SQL(EXPORT_SQL).format(sql.Identifier(table)))
+                for (line,) in cursor:
+                    file.write(line + '\n')
+            conn.commit()
+            partial.replace(path)
+            print(f'{table}: {path}')
+
+            if args.drop:
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL('DROP TABLE {}').format(sql.Identifier(table)))
+                conn.commit()
+    finally:
+        conn.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
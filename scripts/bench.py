@@ -0,0 +1,423 @@
+'''
+Business: Throughput and tail-latency benchmark for auth, online, rooms and ws-messages
+Args: DATABASE_URL env, --target inprocess|http, --url, --users, --duration, --think, --save, --baseline, --tolerance
+Returns: Per-operation requests/sec, p50/p95/p99, DB round-trips and allocations per request; exit code 1 on regression
+'''
+
+import argparse
+import http.client
+import importlib.util
+import json
+import math
+import os
+import random
+import secrets
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+ROOM_CAPACITY = 20
+ALLOC_SAMPLES = 50
+
+# Relative weights of what a lobby user does between two think pauses
+OPERATION_MIX = (
+    ('online_heartbeat', 2),
+    ('online_list', 3),
+    ('rooms_list', 3),
+    ('room_messages', 4),
+    ('ws_poll', 4),
+    ('send_message', 1)
+)
+
+
+class RoundTripCounter:
+    '''Counts statements, implicit BEGINs and commits sent by the handlers, per calling thread'''
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def start(self) -> None:
+        self.local.count = 0
+
+    def stop(self) -> int:
+        count = getattr(self.local, 'count', 0)
+        self.local.count = None
+        return count
+
+    def add(self, n: int = 1) -> None:
+        if getattr(self.local, 'count', None) is not None:
+            self.local.count += n
+
+    def install(self) -> None:
+        counter = self
+        original_connect = psycopg2.connect
+        cursor_classes: Dict[type, type] = {}
+
+        def counting_cursor(base: type) -> type:
+            if base not in cursor_classes:
+                class CountingCursor(base):
+                    def execute(self, query, vars=None):
+                        conn = self.connection
+                        # psycopg2 sends BEGIN on its own before the first statement of a transaction
+                        begins = not conn.autocommit and conn.status == psycopg2.extensions.STATUS_READY
+                        counter.add(2 if begins else 1)
+                        return super().execute(query, vars)
+                cursor_classes[base] = CountingCursor
+            return cursor_classes[base]
+
+        class CountingConnection(psycopg2.extensions.connection):
+            def cursor(self, *args, **kwargs):
+                kwargs['cursor_factory'] = counting_cursor(kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor)
+                return super().cursor(*args, **kwargs)
+
+            def commit(self):
+                if self.status != psycopg2.extensions.STATUS_READY:
+                    counter.add()
+                return super().commit()
+
+        def connect(*args, **kwargs):
+            kwargs['connection_factory'] = CountingConnection
+            return original_connect(*args, **kwargs)
+
+        psycopg2.connect = connect
+
+
+class InProcessTarget:
+    def __init__(self):
+        self.modules = {}
+        for name in ('auth', 'online', 'rooms', 'ws-messages'):
+            spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_index", BACKEND_DIR / name / 'index.py')
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self.modules[name] = module
+
+    def call(self, name: str, method: str, query: Dict[str, str], headers: Dict[str, str], body: str) -> Tuple[int, str]:
+        response = self.modules[name].handler({
+            'httpMethod': method,
+            'queryStringParameters': query,
+            'headers': headers,
+            'body': body,
+            'isBase64Encoded': False
+        }, None)
+        return response['statusCode'], response.get('body') or ''
+
+
+class HttpTarget:
+    '''Talks to `python -m server`, one keep-alive connection per simulated user thread'''
+
+    def __init__(self, url: str):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = conn_class(self.host, timeout=30)
+            self.local.conn = conn
+        return conn
+
+    def call(self, name: str, method: str, query: Dict[str, str], headers: Dict[str, str], body: str) -> Tuple[int, str]:
+        path = f'{self.prefix}/{name}'
+        if query:
+            path += '?' + urllib.parse.urlencode(query)
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body.encode('utf-8') if body else None, headers=dict(headers, **{'Content-Type': 'application/json'}))
+                response = conn.getresponse()
+                return response.status, response.read().decode('utf-8')
+            except (OSError, http.client.HTTPException):
+                # The server closed an idle keep-alive connection; reconnect once
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+        raise RuntimeError('unreachable')
+
+
+class LobbyUser:
+    '''One simulated client: logs in, joins a room, then heartbeats, polls and chats'''
+
+    def __init__(self, target, n: int, room_id: str):
+        self.target = target
+        self.n = n
+        self.room_id = room_id
+        self.rng = random.Random(n)
+        self.user: Dict[str, str] = {}
+        self.token = ''
+        self.last_message_id = 0
+        self.ws_cursor = 0
+
+    def login(self) -> Tuple[int, str]:
+        status, body = self.target.call('auth', 'POST', {}, {}, json.dumps({'nick': f'bench{self.n}', 'avatar': {'type': 'preset', 'value': 'preset_0.png'}, 'color': '#00FFFF'}))
+        if status == 200:
+            data = json.loads(body)
+            self.token = data['token']
+            self.user = {key: data[key] for key in ('user_id', 'nick', 'avatar_url', 'color')}
+        return status, body
+
+    def join(self) -> Tuple[int, str]:
+        return self.target.call('rooms', 'POST', {'room_id': self.room_id, 'action': 'join'}, self.auth_headers(), '')
+
+    def auth_headers(self) -> Dict[str, str]:
+        return {'Authorization': f'Bearer {self.token}'}
+
+    def online_heartbeat(self) -> Tuple[int, str]:
+        return self.target.call('online', 'POST', {}, {'X-Auth-Token': self.token}, '')
+
+    def online_list(self) -> Tuple[int, str]:
+        return self.target.call('online', 'GET', {}, {}, '')
+
+    def rooms_list(self) -> Tuple[int, str]:
+        return self.target.call('rooms', 'GET', {}, {}, '')
+
+    def room_messages(self) -> Tuple[int, str]:
+        query = {'room_id': self.room_id, 'action': 'messages', 'limit': '30'}
+        if self.last_message_id:
+            query['after_id'] = str(self.last_message_id)
+        status, body = self.target.call('rooms', 'GET', query, self.auth_headers(), '')
+        if status == 200:
+            messages = json.loads(body)
+            if messages:
+                self.last_message_id = messages[-1]['id']
+        return status, body
+
+    def ws_poll(self) -> Tuple[int, str]:
+        query = {'token': self.token, 'room_id': self.room_id, 'cursor': str(self.ws_cursor), 'timeout': '0'}
+        status, body = self.target.call('ws-messages', 'GET', query, {}, '')
+        if status == 200:
+            self.ws_cursor = json.loads(body)['cursor']
+        return status, body
+
+    def send_message(self) -> Tuple[int, str]:
+        body = {'text': f'bench message {self.rng.randrange(1000000)}'}
+        return self.target.call('rooms', 'POST', {'room_id': self.room_id, 'action': 'messages'}, self.auth_headers(), json.dumps(body))
+
+
+class Recorder:
+    def __init__(self, counter: Optional[RoundTripCounter]):
+        self.counter = counter
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {}
+        self.round_trips: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+
+    def measure(self, name: str, call) -> None:
+        if self.counter is not None:
+            self.counter.start()
+        started = time.perf_counter()
+        try:
+            status, _ = call()
+            failed = status >= 400
+        except Exception:
+            failed = True
+        elapsed = time.perf_counter() - started
+        round_trips = self.counter.stop() if self.counter is not None else 0
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            self.round_trips[name] = self.round_trips.get(name, 0) + round_trips
+            self.errors[name] = self.errors.get(name, 0) + failed
+
+
+def percentile(values: List[float], p: float) -> float:
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def measure_allocations(user: LobbyUser) -> Dict[str, int]:
+    # Peak bytes allocated while serving one request, median over ALLOC_SAMPLES single-threaded calls
+    results = {}
+    tracemalloc.start()
+    try:
+        for name, _ in OPERATION_MIX:
+            samples = []
+            for _ in range(ALLOC_SAMPLES):
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                getattr(user, name)()
+                samples.append(tracemalloc.get_traced_memory()[1] - before)
+            results[name] = int(statistics.median(samples))
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def cleanup(room_ids: List[str], user_ids: List[str]) -> None:
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute('DELETE FROM messages WHERE room_id = ANY(%s)', (room_ids,))
+            cursor.execute('DELETE FROM room_members WHERE room_id = ANY(%s)', (room_ids,))
+            cursor.execute('DELETE FROM rooms WHERE room_id = ANY(%s)', (room_ids,))
+            cursor.execute('DELETE FROM online_users WHERE user_id = ANY(%s)', (user_ids,))
+            cursor.execute('DELETE FROM users WHERE user_id = ANY(%s)', (user_ids,))
+    finally:
+        conn.close()
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    counter = None
+    if args.target == 'inprocess':
+        counter = RoundTripCounter()
+        counter.install()
+        target = InProcessTarget()
+    else:
+        target = HttpTarget(args.url)
+
+    bootstrap = LobbyUser(target, -1, '')
+    bootstrap.login()
+    room_ids = []
+    for i in range(math.ceil((args.users + 1) / ROOM_CAPACITY)):
+        status, body = target.call('rooms', 'POST', {}, bootstrap.auth_headers(), json.dumps({'name': f'bench-{i}', 'capacity': ROOM_CAPACITY}))
+        if status != 200:
+            raise RuntimeError(f'could not create bench room: {status} {body}')
+        room_ids.append(json.loads(body)['room_id'])
+
+    recorder = Recorder(counter)
+    users = [LobbyUser(target, n, room_ids[n % len(room_ids)]) for n in range(args.users)]
+    for user in users:
+        recorder.measure('auth', user.login)
+        recorder.measure('join', user.join)
+
+    names = [name for name, _ in OPERATION_MIX]
+    weights = [weight for _, weight in OPERATION_MIX]
+    start = threading.Barrier(args.users + 1)
+    stop_at = [0.0]
+
+    def user_loop(user: LobbyUser) -> None:
+        start.wait()
+        while time.monotonic() < stop_at[0]:
+            name = user.rng.choices(names, weights)[0]
+            recorder.measure(name, getattr(user, name))
+            if args.think:
+                time.sleep(user.rng.expovariate(1 / args.think))
+
+    threads = [threading.Thread(target=user_loop, args=(user,), daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+    stop_at[0] = time.monotonic() + args.duration
+    started = time.perf_counter()
+    start.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    allocations = measure_allocations(users[0]) if args.target == 'inprocess' and not args.no_alloc else {}
+
+    operations = {}
+    total = 0
+    for name in ['auth', 'join'] + names:
+        latencies = sorted(recorder.latencies.get(name, []))
+        if not latencies:
+            continue
+        measured = name not in ('auth', 'join')
+        total += len(latencies) if measured else 0
+        operations[name] = {
+            'count': len(latencies),
+            'errors': recorder.errors[name],
+            'rps': round(len(latencies) / elapsed, 1) if measured else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'db_round_trips': round(recorder.round_trips[name] / len(latencies), 2) if counter is not None else None,
+            'alloc_bytes': allocations.get(name)
+        }
+
+    if os.environ.get('DATABASE_URL'):
+        cleanup(room_ids, [user.user.get('user_id', '') for user in users + [bootstrap]])
+
+    return {
+        'target': args.target,
+        'users': args.users,
+        'duration': round(elapsed, 2),
+        'think': args.think,
+        'total_rps': round(total / elapsed, 1),
+        'operations': operations
+    }
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    if result['total_rps'] < baseline['total_rps'] * (1 - tolerance):
+        regressions.append(f"total rps {result['total_rps']} < baseline {baseline['total_rps']}")
+    for name, current in result['operations'].items():
+        before = baseline['operations'].get(name)
+        if before is None or current['rps'] is None:
+            # auth and join run once per user as setup; too few samples to judge
+            continue
+        if current['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name} p95 {current['p95_ms']}ms > baseline {before['p95_ms']}ms")
+        # Round-trips barely move between runs, except for group-committed sends whose batch sizes
+        # follow scheduling, so only growth past the tolerance counts; one more query per request always does
+        if current['db_round_trips'] is not None and before.get('db_round_trips') is not None and \
+                current['db_round_trips'] > before['db_round_trips'] + max(0.05, before['db_round_trips'] * tolerance):
+            regressions.append(f"{name} DB round-trips {current['db_round_trips']} > baseline {before['db_round_trips']}")
+        if current['alloc_bytes'] and before.get('alloc_bytes') and current['alloc_bytes'] > before['alloc_bytes'] * (1 + tolerance):
+            regressions.append(f"{name} allocations {current['alloc_bytes']}B > baseline {before['alloc_bytes']}B")
+    return regressions
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    print(f"{result['target']}: {result['users']} users, {result['duration']}s, {result['total_rps']} req/s")
+    print(f"{'operation':<18}{'count':>8}{'err':>6}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db rt':>7}{'alloc B':>10}")
+    for name, op in result['operations'].items():
+        print(
+            f"{name:<18}{op['count']:>8}{op['errors']:>6}{op['rps'] if op['rps'] is not None else '-':>9}"
+            f"{op['p50_ms']:>9}{op['p95_ms']:>9}{op['p99_ms']:>9}"
+            f"{op['db_round_trips'] if op['db_round_trips'] is not None else '-':>7}"
+            f"{op['alloc_bytes'] if op['alloc_bytes'] is not None else '-':>10}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=('inprocess', 'http'), default='inprocess')
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='base URL of `python -m server` for --target http')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--think', type=float, default=0.0, help='mean pause between a user\'s requests, seconds')
+    parser.add_argument('--no-alloc', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--save', help='write the result as a JSON baseline')
+    parser.add_argument('--baseline', help='compare against a saved baseline and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown against the baseline')
+    args = parser.parse_args()
+
+    if args.target == 'inprocess' and not os.environ.get('DATABASE_URL'):
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 2
+
+    # Functions keep their deployed DB_POOL_MAX_SIZE (4): a bigger pool hides contention for connections
+    # Simulated users send far faster than people do; measure the send path, not the limiter
+    os.environ.setdefault('SEND_USER_RATE', '0')
+    os.environ.setdefault('SEND_ROOM_RATE', '0')
+    if args.target == 'inprocess':
+        # auth signs and the other handlers verify in this process, so any shared secret will do
+        os.environ.setdefault('TOKEN_SECRET', secrets.token_hex(32))
+    result = run(args)
+    print_report(result)
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(result, indent=2) + '\n')
+
+    if args.baseline:
+        regressions = compare(result, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
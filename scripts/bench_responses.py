@@ -0,0 +1,129 @@
+'''
+Business: Micro-benchmark of response building on the hot polling paths that never reach PostgreSQL
+Args: --backend directory to load the functions from, --iterations, --no-orjson to force the stdlib encoder
+Returns: Per-path best-round time per request and median peak bytes allocated per request
+'''
+
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+ALLOC_SAMPLES = 200
+ROUNDS = 20  # time is the best round, which filters out scheduler noise
+BUFFERED_MESSAGES = 5
+PROFILE = {'user_id': 'u-bench', 'nick': 'bench', 'avatar_url': '/avatars/preset_0.png', 'color': '#00FFFF'}
+
+
+def load_handler(backend: Path, name: str):
+    spec = importlib.util.spec_from_file_location(f"bench_{name.replace('-', '_')}_index", backend / name / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def event(method: str, query: Dict[str, str] = None, headers: Dict[str, str] = None, body: str = '') -> Dict[str, Any]:
+    return {'httpMethod': method, 'queryStringParameters': query or {}, 'headers': headers or {}, 'body': body}
+
+
+def build_paths(backend: Path) -> List[Tuple[str, Callable[[], Dict[str, Any]]]]:
+    online = load_handler(backend, 'online')
+    rooms = load_handler(backend, 'rooms')
+    ws = load_handler(backend, 'ws-messages')
+    auth = load_handler(backend, 'auth')
+
+    # Prime the caches the way a first, DB-backed request would
+    users = [dict(PROFILE, user_id=f'u-{n}', nick=f'bench{n}') for n in range(20)]
+    online.store_presence(json.dumps({'users': users}))
+    online_etag = online.handler(event('GET'), None)['headers']['ETag']
+    rooms_body = json.dumps([{'room_id': f'r-{n}', 'name': f'room {n}', 'capacity': 8, 'current': n % 8} for n in range(30)])
+    rooms.store_rooms_cache(42, rooms_body)
+    rooms_etag = rooms.handler(event('GET'), None)['headers']['ETag']
+    for n in range(BUFFERED_MESSAGES):
+        message = {'id': n + 1, 'room_id': 'r-bench', 'author': PROFILE, 'text': f'message {n}', 'created_at': '2024-01-01T00:00:00Z'}
+        body = json.dumps({'room_id': 'r-bench', 'message': message})
+        # Checkouts from before broadcasts were signed take them unsigned
+        headers = {'X-Broadcast-Signature': rooms.sign_broadcast(body.encode('utf-8'))} if hasattr(rooms, 'sign_broadcast') else {}
+        ws.handler(event('POST', headers=headers, body=body), None)
+    token = auth.generate_token(PROFILE['user_id'], PROFILE['nick'], PROFILE['color'])
+    forged = token[:-4] + 'AAAA'
+
+    def refresh() -> None:
+        # Both caches expire within a couple of seconds; keep them warm during the run
+        online.store_presence(json.dumps({'users': users}))
+        rooms.store_rooms_cache(42, rooms_body)
+
+    paths = [
+        ('online_list', lambda: online.handler(event('GET'), None)),
+        ('online_list_304', lambda: online.handler(event('GET', headers={'If-None-Match': online_etag}), None)),
+        ('online_no_token', lambda: online.handler(event('POST'), None)),
+        ('rooms_list', lambda: rooms.handler(event('GET'), None)),
+        ('rooms_list_304', lambda: rooms.handler(event('GET', headers={'If-None-Match': rooms_etag}), None)),
+        ('ws_poll', lambda: ws.handler(event('GET', {'token': token, 'room_id': 'r-bench', 'cursor': '0', 'timeout': '0'}), None)),
+        ('ws_bad_token', lambda: ws.handler(event('GET', {'token': forged, 'room_id': 'r-bench', 'timeout': '0'}), None)),
+        ('ws_options', lambda: ws.handler(event('OPTIONS'), None))
+    ]
+    return [(name, call) for name, call in paths], refresh
+
+
+def measure(paths, refresh: Callable[[], None], iterations: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for name, call in paths:
+        refresh()
+        timings = []
+        for _ in range(ROUNDS):
+            started = time.perf_counter()
+            for _ in range(iterations // ROUNDS):
+                call()
+            timings.append((time.perf_counter() - started) / (iterations // ROUNDS))
+            refresh()
+
+        refresh()
+        samples = []
+        tracemalloc.start()
+        try:
+            for _ in range(ALLOC_SAMPLES):
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                call()
+                samples.append(tracemalloc.get_traced_memory()[1] - before)
+        finally:
+            tracemalloc.stop()
+        results[name] = {'us': min(timings) * 1e6, 'alloc': statistics.median(samples)}
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backend', type=Path, default=BACKEND_DIR)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--no-orjson', action='store_true', help='hide orjson so the handlers fall back to json')
+    args = parser.parse_args()
+
+    if args.no_orjson:
+        sys.modules['orjson'] = None
+    # Nothing here reaches PostgreSQL; the handlers only need the settings to be present
+    os.environ.setdefault('DATABASE_URL', 'postgresql://bench-unused/none')
+    os.environ.setdefault('TOKEN_SECRET', 'bench')
+    os.environ['MESSAGE_BUS'] = 'http'
+    os.environ['METRICS_SAMPLE_RATE'] = '0'
+
+    paths, refresh = build_paths(args.backend)
+    results = measure(paths, refresh, args.iterations)
+
+    print(f"{args.backend} ({'json' if args.no_orjson else 'orjson if installed'})")
+    print(f"{'path':<18}{'us/req':>10}{'alloc B':>10}")
+    for name, result in results.items():
+        print(f"{name:<18}{result['us']:>10.2f}{result['alloc']:>10.0f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
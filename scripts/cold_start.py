@@ -0,0 +1,120 @@
+'''
+Business: Cold-start budget of the four cloud functions, each start measured in a fresh interpreter
+Args: --backend directory to load the functions from, --runs per function and request, --imports N slowest imports to list, --budget ms
+Returns: Median module load time (compile included) and time to first response for a preflight and for a request answered before the database
+'''
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+FUNCTION_NAMES = ('auth', 'online', 'rooms', 'ws-messages')
+
+# The first request a fresh instance typically sees besides a preflight, none of which need PostgreSQL
+FIRST_REQUESTS: Dict[str, Dict[str, Any]] = {
+    'auth': {'httpMethod': 'POST', 'queryStringParameters': {}, 'headers': {}, 'body': '{"nick": ""}'},
+    'online': {'httpMethod': 'POST', 'queryStringParameters': {}, 'headers': {}, 'body': ''},
+    'rooms': {'httpMethod': 'POST', 'queryStringParameters': {'room_id': 'r-cold', 'action': 'send'}, 'headers': {}, 'body': '{"text": "hi"}'},
+    'ws-messages': {'httpMethod': 'GET', 'queryStringParameters': {'room_id': 'r-cold'}, 'headers': {}, 'body': ''}
+}
+PREFLIGHT = {'httpMethod': 'OPTIONS', 'queryStringParameters': {}, 'headers': {}, 'body': ''}
+
+# Runs in the fresh interpreter: everything it needs itself is imported before the clock starts
+# and before the marker, so -X importtime output after the marker belongs to the function.
+# index.py is compiled from source every time, as on a fresh instance without its bytecode
+MARKER = 'cold-start: loading function'
+PROBE = '''
+import json, sys, time, types
+path, event, marker = sys.argv[1], json.loads(sys.argv[2]), sys.argv[3]
+with open(path, encoding='utf-8') as source_file:
+    source = source_file.read()
+sys.stderr.write(marker + '\\n')
+sys.stderr.flush()
+started = time.perf_counter()
+module = types.ModuleType('index')
+module.__file__ = path
+exec(compile(source, path, 'exec'), module.__dict__)
+imported = time.perf_counter()
+status = module.handler(event, None)['statusCode']
+answered = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_ms': (answered - started) * 1000,
+    'status': status,
+    'driver': 'psycopg2' in sys.modules
+}))
+'''
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def probe_env() -> Dict[str, str]:
+    env = dict(os.environ)
+    # Settings have to be present, but nothing measured here reaches PostgreSQL
+    env.setdefault('DATABASE_URL', 'postgresql://cold-start-unused/none')
+    env.setdefault('TOKEN_SECRET', 'cold-start')
+    env['METRICS_SAMPLE_RATE'] = '0'
+    return env
+
+
+def probe(backend: Path, name: str, event: Dict[str, Any], extra_args: Tuple[str, ...] = ()) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *extra_args, '-c', PROBE, str(backend / name / 'index.py'), json.dumps(event), MARKER],
+        capture_output=True, text=True, env=probe_env(), check=True
+    )
+
+
+def measure(backend: Path, name: str, event: Dict[str, Any], runs: int) -> Dict[str, Any]:
+    samples = [json.loads(probe(backend, name, event).stdout) for _ in range(runs)]
+    return {
+        'import_ms': statistics.median(sample['import_ms'] for sample in samples),
+        'first_ms': statistics.median(sample['first_ms'] for sample in samples),
+        'status': samples[0]['status'],
+        'driver': samples[0]['driver']
+    }
+
+
+def slowest_imports(backend: Path, name: str, count: int) -> List[Tuple[str, int]]:
+    '''Top-level imports of the function by cumulative microseconds, from python -X importtime'''
+    stderr = probe(backend, name, PREFLIGHT, ('-X', 'importtime')).stderr
+    imports = []
+    for line in stderr.partition(MARKER)[2].splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match and not match.group(3):
+            imports.append((match.group(4), int(match.group(2))))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:count]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backend', type=Path, default=BACKEND_DIR)
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--imports', type=int, default=0, help='list this many of the slowest imports per function')
+    parser.add_argument('--budget', type=float, help='fail when a median time to first response exceeds this many ms')
+    args = parser.parse_args()
+
+    print(f'{args.backend} (median of {args.runs} fresh interpreters)')
+    print(f"{'function':<13}{'request':<11}{'status':>7}{'import ms':>11}{'first ms':>10}  psycopg2")
+    over_budget = []
+    for name in FUNCTION_NAMES:
+        for label, event in (('preflight', PREFLIGHT), ('first', FIRST_REQUESTS[name])):
+            result = measure(args.backend, name, event, args.runs)
+            print(f"{name:<13}{label:<11}{result['status']:>7}{result['import_ms']:>11.1f}{result['first_ms']:>10.1f}  {'loaded' if result['driver'] else '-'}")
+            if args.budget is not None and result['first_ms'] > args.budget:
+                over_budget.append(f"{name} {label}: {result['first_ms']:.1f} ms > {args.budget:.1f} ms")
+        for module, micros in slowest_imports(args.backend, name, args.imports):
+            print(f'    {module:<30}{micros / 1000:>8.1f} ms')
+
+    for line in over_budget:
+        print(f'OVER BUDGET {line}')
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
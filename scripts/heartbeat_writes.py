@@ -0,0 +1,125 @@
+'''
+Business: Simulates lobby heartbeats against the online function's coalescing on a virtual clock, without PostgreSQL
+Args: --backend directory to load the functions from, --users, --duration seconds, --interval and --jitter of the client heartbeat, --leave share of users who stop midway
+Returns: Heartbeats, last_seen row writes per heartbeat and UPDATE statements, plus every moment a user who was still sending looked offline; fails on any
+'''
+
+import argparse
+import heapq
+import importlib.util
+import random
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+CLOCK_START = 1000.0  # the module's flush bookkeeping starts at 0.0
+PROBE_INTERVAL = 0.5  # how often every user's presence is checked
+
+
+class VirtualClock:
+    '''Stands in for the time module inside online/index.py'''
+
+    def __init__(self):
+        self.now = CLOCK_START
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+
+def load_online(backend: Path, clock: VirtualClock):
+    spec = importlib.util.spec_from_file_location('heartbeat_online_index', backend / 'online' / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.time = clock
+    return module
+
+
+def simulate(args: argparse.Namespace) -> Dict[str, float]:
+    clock = VirtualClock()
+    online = load_online(args.backend, clock)
+    rng = random.Random(args.seed)
+    end = CLOCK_START + args.duration
+
+    # (time, kind, user); kind 0 = heartbeat, 1 = presence probe
+    events: List[Tuple[float, int, int]] = []
+    leaves_at = {}
+    for user in range(args.users):
+        heapq.heappush(events, (CLOCK_START + rng.uniform(0, args.interval), 0, user))
+        if rng.random() < args.leave:
+            leaves_at[user] = CLOCK_START + rng.uniform(0, args.duration)
+    probe = CLOCK_START
+    while probe < end:
+        heapq.heappush(events, (probe, 1, -1))
+        probe += PROBE_INTERVAL
+
+    stored: Dict[int, float] = {}  # user -> last_seen as the database has it
+    sent: Dict[int, float] = {}  # user -> when its latest heartbeat really arrived
+    counts = {'heartbeats': 0, 'row_writes': 0, 'statements': 0, 'false_offline': 0}
+
+    while events:
+        clock.now, kind, user = heapq.heappop(events)
+        if clock.now >= end:
+            break
+
+        if kind == 1:
+            for other, last in sent.items():
+                # Still sending, yet the presence query (last_seen >= now - TTL) would leave it out
+                if clock.now - last < online.ONLINE_TTL and clock.now - stored.get(other, float('-inf')) > online.ONLINE_TTL:
+                    counts['false_offline'] += 1
+            continue
+
+        counts['heartbeats'] += 1
+        sent[user] = clock.now
+        absorbed = online.absorb_heartbeat(str(user))
+        due = online.take_due_heartbeats()
+        if not absorbed:
+            stored[user] = clock.now
+            online.mark_heartbeat_written(str(user))
+            counts['row_writes'] += 1
+            counts['statements'] += 1
+        if due:
+            for user_id, age in due:
+                stored[int(user_id)] = max(stored.get(int(user_id), float('-inf')), clock.now - age)
+            counts['row_writes'] += len(due)
+            counts['statements'] += 1
+
+        next_beat = clock.now + args.interval + rng.uniform(0, args.jitter)
+        if next_beat < leaves_at.get(user, end):
+            heapq.heappush(events, (next_beat, 0, user))
+
+    counts['writes_per_heartbeat'] = counts['row_writes'] / max(1, counts['heartbeats'])
+    return counts
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backend', type=Path, default=BACKEND_DIR)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=600.0)
+    parser.add_argument('--interval', type=float, default=10.0, help='client heartbeat period, seconds (Lobby.tsx)')
+    parser.add_argument('--jitter', type=float, default=1.0, help='each heartbeat arrives up to this many seconds late')
+    parser.add_argument('--leave', type=float, default=0.2, help='share of users who stop sending at a random moment')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-writes', type=float, help='fail when row writes per heartbeat exceed this')
+    args = parser.parse_args()
+
+    result = simulate(args)
+    print(f'{args.backend}: {args.users} users, {args.duration:.0f}s, heartbeat every {args.interval:g}s (+{args.jitter:g}s)')
+    print(f"heartbeats          {result['heartbeats']:>8}")
+    print(f"last_seen row writes{result['row_writes']:>8}  ({result['writes_per_heartbeat']:.2f} per heartbeat)")
+    print(f"write statements    {result['statements']:>8}")
+    print(f"false offline       {result['false_offline']:>8}  (probes every {PROBE_INTERVAL:g}s)")
+
+    failed = result['false_offline'] > 0
+    if args.max_writes is not None and result['writes_per_heartbeat'] > args.max_writes:
+        print(f"OVER BUDGET {result['writes_per_heartbeat']:.2f} writes per heartbeat > {args.max_writes:.2f}")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
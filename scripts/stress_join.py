@@ -0,0 +1,115 @@
+'''
+Business: Concurrency stress test for rooms join/leave against a real PostgreSQL
+Args: DATABASE_URL env, --rooms, --capacity, --users, --rounds
+Returns: Exit code 0 when no room ends up over capacity or out of sync with room_members
+'''
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import secrets
+import sys
+import threading
+from pathlib import Path
+from typing import Any, Dict, List
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+
+def load_handler(name: str):
+    spec = importlib.util.spec_from_file_location(f'{name}_index', BACKEND_DIR / name / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def call(module, method: str, params: Dict[str, str], body: Dict[str, Any], token: str = '') -> Dict[str, Any]:
+    return module.handler({
+        'httpMethod': method,
+        'queryStringParameters': params,
+        'headers': {'Authorization': f'Bearer {token}'},
+        'body': json.dumps(body)
+    }, None)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--capacity', type=int, default=4)
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 2
+
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.users))
+    # auth and rooms run in this process, so any shared secret will do
+    os.environ.setdefault('TOKEN_SECRET', secrets.token_hex(32))
+    auth = load_handler('auth')
+    rooms = load_handler('rooms')
+
+    room_ids: List[str] = []
+    for i in range(args.rooms):
+        response = call(rooms, 'POST', {}, {'name': f'stress-{i}', 'capacity': args.capacity})
+        room_ids.append(json.loads(response['body'])['room_id'])
+
+    statuses: Dict[int, int] = {}
+    user_ids: List[str] = []
+    statuses_lock = threading.Lock()
+    start = threading.Barrier(args.users)
+
+    def user_worker(n: int) -> None:
+        user = json.loads(call(auth, 'POST', {}, {'nick': f'u{n}', 'color': '#00FFFF'})['body'])
+        token = user['token']
+        with statuses_lock:
+            user_ids.append(user['user_id'])
+        rng = random.Random(n)
+        start.wait()
+        for _ in range(args.rounds):
+            room_id = rng.choice(room_ids)
+            # Duplicate joins race against each other on purpose
+            for _ in range(rng.choice([1, 1, 2])):
+                status = call(rooms, 'POST', {'room_id': room_id, 'action': 'join'}, {}, token)['statusCode']
+                with statuses_lock:
+                    statuses[status] = statuses.get(status, 0) + 1
+            if rng.random() < 0.7:
+                call(rooms, 'POST', {'room_id': room_id, 'action': 'leave'}, {}, token)
+
+    threads = [threading.Thread(target=user_worker, args=(n,)) for n in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    conn = rooms.db_pool.acquire()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                '''SELECT r.room_id, r.capacity, r.current_users,
+                          (SELECT count(*) FROM room_members m WHERE m.room_id = r.room_id) AS members
+                   FROM rooms r WHERE r.room_id = ANY(%s)''',
+                (room_ids,)
+            )
+            rows = cursor.fetchall()
+            cursor.execute('DELETE FROM room_members WHERE room_id = ANY(%s)', (room_ids,))
+            cursor.execute('DELETE FROM rooms WHERE room_id = ANY(%s)', (room_ids,))
+            cursor.execute('DELETE FROM users WHERE user_id = ANY(%s)', (user_ids,))
+    finally:
+        rooms.db_pool.release(conn)
+
+    print(f'join statuses: {dict(sorted(statuses.items()))}')
+    failures = 0
+    for row in rows:
+        ok = row['current_users'] <= row['capacity'] and row['current_users'] == row['members']
+        failures += not ok
+        print(f"{row['room_id']}: current={row['current_users']} members={row['members']} capacity={row['capacity']} {'ok' if ok else 'FAIL'}")
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+'''
+Business: Keeps the code the cloud functions share in one place: every backend/<name>/index.py carries verbatim copies of backend/_shared/*.py.in between "# shared:begin <block>" and "# shared:end <block>" lines
+Args: --backend directory holding the functions and _shared, --write to copy _shared into the functions instead of only checking
+Returns: Which functions carry which block, a diff for every copy that differs from its source and every name a block reads that its function never binds; exits 1 on any of them or a broken marker (differences alone are fixed by --write)
+'''
+
+import argparse
+import builtins
+import difflib
+import re
+import symtable
+import sys
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+SHARED_DIR_NAME = '_shared'
+# Fragments, not modules: they read names their function binds, so linters must not see them as .py
+SHARED_SUFFIX = '.py.in'
+BEGIN_LINE = re.compile(r'^# shared:begin (\w+)\b')
+END_LINE = '# shared:end {}\n'
+
+
+def load_shared(backend: Path) -> Dict[str, str]:
+    paths = sorted((backend / SHARED_DIR_NAME).glob('*' + SHARED_SUFFIX))
+    return {path.name[:-len(SHARED_SUFFIX)]: path.read_text(encoding='utf-8') for path in paths}
+
+
+def function_sources(backend: Path) -> List[Path]:
+    return sorted(path for path in backend.glob('*/index.py') if not path.parent.name.startswith('_'))
+
+
+def module_names(source: str, filename: str) -> Tuple[Set[str], Set[str]]:
+    '''(globals the code binds, globals it reads without binding them itself), builtins aside'''
+    top = symtable.symtable(source, filename, 'exec')
+    bound = {symbol.get_name() for symbol in top.get_symbols() if symbol.is_assigned() or symbol.is_imported()}
+    read = set()
+    tables = [top]
+    while tables:
+        table = tables.pop()
+        tables.extend(table.get_children())
+        for symbol in table.get_symbols():
+            if table is top:
+                if symbol.is_referenced():
+                    read.add(symbol.get_name())
+            elif symbol.is_declared_global() and (symbol.is_assigned() or symbol.is_imported()):
+                bound.add(symbol.get_name())
+            elif symbol.is_global() and symbol.is_referenced():
+                read.add(symbol.get_name())
+    return bound, read - bound - set(dir(builtins))
+
+
+def find_blocks(lines: List[str]) -> List[Tuple[str, int, int]]:
+    '''(block, first line of the copy, line of its end marker), raising ValueError on a broken marker'''
+    blocks = []
+    index = 0
+    while index < len(lines):
+        match = BEGIN_LINE.match(lines[index])
+        if match:
+            name = match.group(1)
+            end_marker = END_LINE.format(name)
+            try:
+                end = lines.index(end_marker, index + 1)
+            except ValueError:
+                raise ValueError(f'line {index + 1}: "# shared:begin {name}" has no "{end_marker.strip()}"') from None
+            nested = next((line for line in lines[index + 1:end] if BEGIN_LINE.match(line)), None)
+            if nested:
+                raise ValueError(f'line {index + 1}: "# shared:begin {name}" is not closed before {nested.strip()!r}')
+            blocks.append((name, index + 1, end))
+            index = end
+        index += 1
+    return blocks
+
+
+def sync(path: Path, shared: Dict[str, str], write: bool, users: Dict[str, List[str]]) -> List[str]:
+    '''Problems found in one index.py; with write, the copies that differed are replaced instead'''
+    function = path.parent.name
+    lines = path.read_text(encoding='utf-8').splitlines(keepends=True)
+    try:
+        blocks = find_blocks(lines)
+    except ValueError as error:
+        return [f'{function}: {error}']
+
+    for name, _, _ in blocks:
+        users.setdefault(name, []).append(function)
+    problems = []
+    # Back to front, so replacing a copy does not move the blocks still to come
+    for name, start, end in reversed(blocks):
+        if name not in shared:
+            problems.append(f'{function}: block {name!r} has no {SHARED_DIR_NAME}/{name}{SHARED_SUFFIX}')
+            continue
+        copy, source = ''.join(lines[start:end]), shared[name]
+        if copy == source:
+            continue
+        if write:
+            lines[start:end] = [source]
+            continue
+        diff = difflib.unified_diff(
+            source.splitlines(keepends=True), copy.splitlines(keepends=True),
+            f'{SHARED_DIR_NAME}/{name}{SHARED_SUFFIX}', f'{function}/index.py ({name})'
+        )
+        problems.append(f'{function}: {name} differs from {SHARED_DIR_NAME}/{name}{SHARED_SUFFIX}\n' + ''.join(diff).rstrip('\n'))
+
+    text = ''.join(lines)
+    if write and text != path.read_text(encoding='utf-8'):
+        path.write_text(text, encoding='utf-8')
+        print(f'rewrote {function}/index.py')
+
+    bound = module_names(text, str(path))[0]
+    for name, _, _ in blocks:
+        if name in shared:
+            unbound = module_names(shared[name], name + SHARED_SUFFIX)[1] - bound
+            if unbound:
+                problems.append(f"{function}: {name} reads {', '.join(sorted(unbound))}, which index.py never binds")
+    return problems
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backend', type=Path, default=BACKEND_DIR)
+    parser.add_argument('--write', action='store_true', help='copy backend/_shared into every function')
+    args = parser.parse_args()
+
+    shared = load_shared(args.backend)
+    users: Dict[str, List[str]] = {}
+    problems = []
+    for path in function_sources(args.backend):
+        problems.extend(sync(path, shared, args.write, users))
+
+    for name in shared:
+        print(f"{name:<14}{', '.join(users.get(name, [])) or 'unused'}")
+    for problem in problems:
+        print(f'DRIFT {problem}')
+    if problems and not args.write:
+        print(f'Edit backend/{SHARED_DIR_NAME} and run scripts/sync_shared.py --write')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,283 @@
+'''
+Business: Self-hosted asyncio HTTP host for all four cloud functions plus the SSE stream
+Args: --host, --port, --workers, --threads; requests go to /auth, /online, /rooms, /ws-messages, /stream
+Returns: Each function's response exactly as its handler built it
+'''
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from server.functions import FUNCTION_NAMES, build_event, invoke, load_function
+from server.stream import StreamHub, Subscriber
+
+STREAM_KEEPALIVE_INTERVAL = 15.0
+HANDLER_THREADS = int(os.environ.get('HOST_HANDLER_THREADS', '32'))
+LONG_POLL_THREADS = int(os.environ.get('HOST_LONG_POLL_THREADS', '256'))
+MAX_HEADER_LINES = 100
+MAX_BODY_BYTES = 1024 * 1024
+KEEPALIVE_IDLE_TIMEOUT = 75.0
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Auth-Token',
+    'Access-Control-Max-Age': '86400'
+}
+
+logger = logging.getLogger(__name__)
+
+
+class Request:
+    def __init__(self, method: str, path: str, query: Dict[str, str], headers: Dict[str, str], body: bytes, version: str):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.lower_headers = {name.lower(): value for name, value in headers.items()}
+        self.body = body
+        self.version = version
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.lower_headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+class Host:
+    '''Shared state of one worker process: handler thread pools and the stream hub'''
+
+    def __init__(self, handler_threads: int, long_poll_threads: int):
+        self.handler_executor = ThreadPoolExecutor(max_workers=handler_threads, thread_name_prefix='handler')
+        # ws-messages GET parks for up to its long-poll timeout, so it gets its own pool
+        self.long_poll_executor = ThreadPoolExecutor(max_workers=long_poll_threads, thread_name_prefix='long-poll')
+        self.hub = StreamHub(self.handler_executor)
+
+    def preload(self) -> None:
+        for name in FUNCTION_NAMES:
+            load_function(name)
+        # Room broadcasts land in this process's ws-messages buffer without an HTTP hop
+        load_function('rooms').broadcaster.deliver = deliver_broadcast
+
+    def executor_for(self, name: str, method: str) -> ThreadPoolExecutor:
+        if name == 'ws-messages' and method == 'GET':
+            return self.long_poll_executor
+        return self.handler_executor
+
+
+def deliver_broadcast(body: bytes, headers: Dict[str, str]) -> int:
+    return invoke('ws-messages', 'POST', headers=headers, body=body.decode('utf-8'))['statusCode']
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, version = request_line.decode('latin-1').strip().split(' ', 2)
+    except ValueError:
+        return None
+
+    headers: Dict[str, str] = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip()] = value.strip()
+
+    length = int(next((value for name, value in headers.items() if name.lower() == 'content-length'), 0) or 0)
+    if length > MAX_BODY_BYTES:
+        return None
+    body = await reader.readexactly(length) if length else b''
+    url = urlsplit(target)
+    return Request(method.upper(), url.path, dict(parse_qsl(url.query)), headers, body, version)
+
+
+def encode_response(status: int, headers: Dict[str, str], body: bytes, keep_alive: bool) -> bytes:
+    try:
+        reason = HTTPStatus(status).phrase
+    except ValueError:
+        reason = ''
+    lines = [f'HTTP/1.1 {status} {reason}']
+    lines.extend(f'{name}: {value}' for name, value in headers.items())
+    lines.append(f'Content-Length: {len(body)}')
+    lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+def encode_json(status: int, payload: Dict, keep_alive: bool) -> bytes:
+    return encode_response(status, dict(CORS_HEADERS, **{'Content-Type': 'application/json'}), json.dumps(payload).encode('utf-8'), keep_alive)
+
+
+def resolve_function(path: str) -> Optional[str]:
+    name = path.strip('/').split('/', 1)[0]
+    return name if name in FUNCTION_NAMES else None
+
+
+async def call_function(host: Host, name: str, request: Request) -> bytes:
+    event = build_event(request.method, request.query, request.headers, request.body.decode('utf-8'))
+    handler = load_function(name).handler
+    loop = asyncio.get_running_loop()
+    try:
+        response = await loop.run_in_executor(host.executor_for(name, request.method), handler, event, None)
+    except Exception:
+        logger.exception('%s handler failed', name)
+        return encode_json(502, {'error': 'Function failed'}, request.keep_alive)
+
+    body = response.get('body') or ''
+    payload = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode('utf-8')
+    headers = {name: str(value) for name, value in (response.get('headers') or {}).items()}
+    return encode_response(response.get('statusCode', 200), headers, payload, request.keep_alive)
+
+
+def stream_topics(request: Request) -> Tuple[str, ...]:
+    room_id = request.query.get('room_id')
+    if room_id:
+        return ('presence', 'rooms', f'room:{room_id}')
+    return ('presence', 'rooms')
+
+
+async def serve_stream(host: Host, request: Request, writer: asyncio.StreamWriter) -> None:
+    token = request.query.get('token', '')
+    room_id = request.query.get('room_id')
+    loop = asyncio.get_running_loop()
+
+    if room_id:
+        # Room traffic is protected; check the token once through the rooms handler itself
+        response = await loop.run_in_executor(
+            host.handler_executor,
+            lambda: invoke('rooms', 'GET', query={'room_id': room_id, 'action': 'members'}, headers={'Authorization': f'Bearer {token}'})
+        )
+        if response['statusCode'] != 200:
+            writer.write(encode_json(response['statusCode'], json.loads(response['body']), False))
+            await writer.drain()
+            return
+    else:
+        # The lobby carries presence and the room list, so it takes the token check online does
+        valid = await loop.run_in_executor(host.handler_executor, lambda: load_function('online').verify_token(token) is not None)
+        if not valid:
+            writer.write(encode_json(401, {'error': 'Invalid token' if token else 'Missing token'}, False))
+            await writer.drain()
+            return
+
+    head = dict(CORS_HEADERS, **{
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Connection': 'close',
+        'X-Accel-Buffering': 'no'
+    })
+    writer.write(('HTTP/1.1 200 OK\r\n' + ''.join(f'{name}: {value}\r\n' for name, value in head.items()) + '\r\n').encode('latin-1'))
+    writer.write(b'retry: 3000\n\n')
+    await writer.drain()
+
+    subscriber = Subscriber(token)
+    topics = stream_topics(request)
+    host.hub.subscribe(subscriber, topics)
+    try:
+        while not subscriber.closed:
+            try:
+                frame = await asyncio.wait_for(subscriber.queue.get(), STREAM_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                frame = b': keepalive\n\n'
+            writer.write(frame)
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        host.hub.unsubscribe(subscriber, topics)
+
+
+async def handle_connection(host: Host, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(read_request(reader), KEEPALIVE_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                return
+            if request is None:
+                return
+
+            if request.method == 'GET' and request.path == '/stream':
+                await serve_stream(host, request, writer)
+                return
+
+            name = resolve_function(request.path)
+            if name is not None:
+                writer.write(await call_function(host, name, request))
+            elif request.method == 'OPTIONS':
+                writer.write(encode_response(204, CORS_HEADERS, b'', request.keep_alive))
+            else:
+                writer.write(encode_json(404, {'error': 'Not found'}, request.keep_alive))
+            await writer.drain()
+
+            if not request.keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host_name: str, port: int, handler_threads: int, long_poll_threads: int, reuse_port: bool) -> None:
+    host = Host(handler_threads, long_poll_threads)
+    host.preload()
+    server = await asyncio.start_server(
+        lambda r, w: handle_connection(host, r, w), host_name, port, reuse_port=reuse_port, backlog=1024
+    )
+    logger.info('worker %s listening on %s:%s', os.getpid(), host_name, port)
+    async with server:
+        await server.serve_forever()
+
+
+def run_worker(host_name: str, port: int, handler_threads: int, long_poll_threads: int, reuse_port: bool) -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    try:
+        asyncio.run(serve(host_name, port, handler_threads, long_poll_threads, reuse_port))
+    except KeyboardInterrupt:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run auth, online, rooms, ws-messages and the SSE stream in one host')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1, help='worker processes sharing the port via SO_REUSEPORT')
+    parser.add_argument('--threads', type=int, default=HANDLER_THREADS, help='handler threads per worker')
+    parser.add_argument('--long-poll-threads', type=int, default=LONG_POLL_THREADS, help='ws-messages long-poll threads per worker')
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        run_worker(args.host, args.port, args.threads, args.long_poll_threads, False)
+        return
+
+    # Each worker owns its pools and caches; the kernel spreads connections across them
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(target=run_worker, args=(args.host, args.port, args.threads, args.long_poll_threads, True), daemon=True)
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+
+if __name__ == '__main__':
+    main()
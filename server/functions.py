@@ -0,0 +1,47 @@
+'''
+Business: Loads the cloud-function handlers from backend/ into this process and invokes them
+Args: function name (auth, online, rooms, ws-messages) plus HTTP method, query, headers, body
+Returns: The handler's response dict, exactly as the cloud runtime would receive it
+'''
+
+import importlib.util
+import threading
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Dict, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+FUNCTION_NAMES = ('auth', 'online', 'rooms', 'ws-messages')
+
+_modules: Dict[str, ModuleType] = {}
+_modules_lock = threading.Lock()
+
+
+def load_function(name: str) -> ModuleType:
+    module = _modules.get(name)
+    if module is not None:
+        return module
+
+    with _modules_lock:
+        module = _modules.get(name)
+        if module is None:
+            # Every function lives in an index.py, so each gets its own module name
+            spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_index", BACKEND_DIR / name / 'index.py')
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _modules[name] = module
+    return module
+
+
+def build_event(method: str, query: Optional[Dict[str, str]] = None, headers: Optional[Dict[str, str]] = None, body: str = '') -> Dict[str, Any]:
+    return {
+        'httpMethod': method,
+        'queryStringParameters': query or {},
+        'headers': headers or {},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+
+def invoke(name: str, method: str, query: Optional[Dict[str, str]] = None, headers: Optional[Dict[str, str]] = None, body: str = '') -> Dict[str, Any]:
+    return load_function(name).handler(build_event(method, query, headers, body), None)
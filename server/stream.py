@@ -0,0 +1,226 @@
+'''
+Business: Server-Sent Events hub that multiplexes presence, room list and room updates
+Args: subscribers register topic keys ('presence', 'rooms', 'room:<id>')
+Returns: SSE frames; one shared poller per topic feeds every subscriber of that topic
+'''
+
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from typing import Dict, Iterable, List, Optional, Set
+
+from server.functions import invoke
+
+PRESENCE_POLL_INTERVAL = 2.0
+ROOMS_POLL_INTERVAL = 1.0
+ROOM_POLL_INTERVAL = 1.0
+ROOM_RECENT_MESSAGES = 30
+SUBSCRIBER_QUEUE_MAX = 256
+
+logger = logging.getLogger(__name__)
+
+
+def format_event(name: str, data: str) -> bytes:
+    return f'event: {name}\ndata: {data}\n\n'.encode('utf-8')
+
+
+class Subscriber:
+    '''One client connection; frames are queued here and written out by the connection task'''
+
+    def __init__(self, token: str):
+        self.token = token
+        self.queue: 'asyncio.Queue[bytes]' = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_MAX)
+        self.closed = False
+
+    def push(self, frame: bytes) -> None:
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # A client this far behind is dropped rather than buffered without bound
+            self.closed = True
+
+
+class Topic(ABC):
+    '''Polls one source through the existing handlers and fans changes out to subscribers'''
+
+    interval = 1.0
+
+    def __init__(self, hub: 'StreamHub', key: str):
+        self.hub = hub
+        self.key = key
+        self.subscribers: Set[Subscriber] = set()
+        self.snapshot: List[bytes] = []
+        self.task: Optional[asyncio.Task] = None
+
+    @abstractmethod
+    def poll(self, token: str) -> List[bytes]:
+        '''Frames for what changed since the last poll; runs on the hub's executor'''
+
+    def after_poll(self) -> None:
+        pass
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.subscribers:
+            token = next(iter(self.subscribers)).token
+            try:
+                frames = await loop.run_in_executor(self.hub.executor, self.poll, token)
+            except Exception:
+                logger.exception('stream topic %s poll failed', self.key)
+                frames = []
+            for frame in frames:
+                for subscriber in list(self.subscribers):
+                    subscriber.push(frame)
+            self.after_poll()
+            await asyncio.sleep(self.interval)
+
+
+class PresenceTopic(Topic):
+    interval = PRESENCE_POLL_INTERVAL
+
+    def __init__(self, hub: 'StreamHub', key: str):
+        super().__init__(hub, key)
+        self.etag: Optional[str] = None
+
+    def poll(self, token: str) -> List[bytes]:
+        response = invoke('online', 'GET', headers={'If-None-Match': self.etag} if self.etag else {})
+        if response['statusCode'] != 200:
+            return []
+        self.etag = response['headers'].get('ETag')
+        frame = format_event('presence', response['body'])
+        self.snapshot = [frame]
+        return [frame]
+
+
+class RoomsTopic(Topic):
+    interval = ROOMS_POLL_INTERVAL
+
+    def __init__(self, hub: 'StreamHub', key: str):
+        super().__init__(hub, key)
+        self.version: Optional[int] = None
+        self.rooms: List[Dict] = []
+        self.changed_room_ids: List[str] = []
+
+    def poll(self, token: str) -> List[bytes]:
+        if self.version is None:
+            response = invoke('rooms', 'GET')
+            if response['statusCode'] != 200:
+                return []
+            self.version = int(response['headers']['X-Rooms-Version'])
+            self.rooms = json.loads(response['body'])
+            changed = self.rooms
+            full = True
+        else:
+            response = invoke('rooms', 'GET', query={'since_version': str(self.version)})
+            if response['statusCode'] != 200:
+                return []
+            delta = json.loads(response['body'])
+            self.version = delta['version']
+            changed = delta['rooms']
+            full = False
+            if not changed:
+                return []
+            by_id = {room['room_id']: index for index, room in enumerate(self.rooms)}
+            for room in changed:
+                room.pop('version', None)
+                if room['room_id'] in by_id:
+                    self.rooms[by_id[room['room_id']]] = room
+                else:
+                    self.rooms.insert(0, room)
+
+        self.changed_room_ids = [room['room_id'] for room in changed]
+        self.snapshot = [format_event('rooms', json.dumps({'version': self.version, 'rooms': self.rooms, 'full': True}))]
+        return [format_event('rooms', json.dumps({'version': self.version, 'rooms': changed, 'full': full}))]
+
+    def after_poll(self) -> None:
+        for room_id in self.changed_room_ids:
+            topic = self.hub.topics.get(f'room:{room_id}')
+            if isinstance(topic, RoomTopic):
+                topic.members_dirty = True
+        self.changed_room_ids = []
+
+
+class RoomTopic(Topic):
+    interval = ROOM_POLL_INTERVAL
+
+    def __init__(self, hub: 'StreamHub', key: str):
+        super().__init__(hub, key)
+        self.room_id = key.split(':', 1)[1]
+        self.last_id: Optional[int] = None
+        self.recent: List[Dict] = []
+        self.members_frame: Optional[bytes] = None
+        self.members_dirty = True
+
+    def poll(self, token: str) -> List[bytes]:
+        headers = {'Authorization': f'Bearer {token}'}
+        frames = []
+
+        query = {'room_id': self.room_id, 'action': 'messages', 'limit': str(ROOM_RECENT_MESSAGES)}
+        if self.last_id is not None:
+            query['after_id'] = str(self.last_id)
+        response = invoke('rooms', 'GET', query=query, headers=headers)
+        if response['statusCode'] == 200:
+            messages = json.loads(response['body'])
+            if messages or self.last_id is None:
+                frames.append(format_event('messages', json.dumps(messages)))
+            if messages:
+                self.last_id = messages[-1]['id']
+                self.recent = (self.recent + messages)[-ROOM_RECENT_MESSAGES:]
+            elif self.last_id is None:
+                self.last_id = 0
+
+        if self.members_dirty:
+            self.members_dirty = False
+            response = invoke('rooms', 'GET', query={'room_id': self.room_id, 'action': 'members'}, headers=headers)
+            if response['statusCode'] == 200:
+                self.members_frame = format_event('members', response['body'])
+                frames.append(self.members_frame)
+
+        self.snapshot = [format_event('messages', json.dumps(self.recent))]
+        if self.members_frame is not None:
+            self.snapshot.append(self.members_frame)
+        return frames
+
+
+class StreamHub:
+    '''Keeps one topic per key alive while it has subscribers'''
+
+    def __init__(self, executor: Executor):
+        self.executor = executor
+        self.topics: Dict[str, Topic] = {}
+
+    def _create_topic(self, key: str) -> Topic:
+        if key == 'presence':
+            return PresenceTopic(self, key)
+        if key == 'rooms':
+            return RoomsTopic(self, key)
+        if key.startswith('room:'):
+            return RoomTopic(self, key)
+        raise KeyError(key)
+
+    def subscribe(self, subscriber: Subscriber, keys: Iterable[str]) -> None:
+        for key in keys:
+            topic = self.topics.get(key)
+            if topic is None:
+                topic = self._create_topic(key)
+                self.topics[key] = topic
+            topic.subscribers.add(subscriber)
+            for frame in topic.snapshot:
+                subscriber.push(frame)
+            if topic.task is None or topic.task.done():
+                topic.task = asyncio.create_task(topic.run())
+
+    def unsubscribe(self, subscriber: Subscriber, keys: Iterable[str]) -> None:
+        for key in keys:
+            topic = self.topics.get(key)
+            if topic is None:
+                continue
+            topic.subscribers.discard(subscriber)
+            if not topic.subscribers:
+                if topic.task is not None:
+                    topic.task.cancel()
+                del self.topics[key]
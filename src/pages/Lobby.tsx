@@ -27,6 +27,7 @@ const WS_API = 'https://functions.poehali.dev/2536b900-bcea-4f56-a373-de560254c8
 const HEARTBEAT_INTERVAL = 10000;
 const POLL_INTERVAL = 5000;
 const TOAST_DEBOUNCE_MS = 5000;
+const STREAM_API = import.meta.env.VITE_STREAM_API as string | undefined;
 
 export default function Lobby() {
   const [onlineUsers, setOnlineUsers] = useState<User[]>([]);
@@ -45,57 +46,54 @@ export default function Lobby() {
 
   const sendHeartbeat = async () => {
     const token = localStorage.getItem('token');
-    const userId = localStorage.getItem('user_id');
-    const nick = localStorage.getItem('nick');
-    const avatarUrl = localStorage.getItem('avatar_url');
-    const color = localStorage.getItem('color');
-
-    if (!token || !userId || !nick || !avatarUrl || !color) return;
+    if (!token) return;
 
     try {
-      await fetch(ONLINE_API, {
+      const response = await fetch(ONLINE_API, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
           'X-Auth-Token': token,
         },
-        body: JSON.stringify({
-          user_id: userId,
-          nick,
-          avatar_url: avatarUrl,
-          color,
-        }),
       });
+
+      if (response.status === 401) {
+        // Expired or pre-signing token: send the user back to log in again
+        localStorage.removeItem('token');
+        navigate('/');
+      }
     } catch (error) {
       console.error('Heartbeat error:', error);
     }
   };
 
+  const applyOnlineUsers = (newUsers: User[]) => {
+    const newUserIds = new Set(newUsers.map(u => u.user_id));
+    const currentTime = Date.now();
+
+    newUsers.forEach(user => {
+      if (!previousUserIds.has(user.user_id)) {
+        const currentUserId = localStorage.getItem('user_id');
+        if (user.user_id !== currentUserId) {
+          const lastShown = lastToastTimestamp.current.get(user.user_id) || 0;
+          if (currentTime - lastShown > TOAST_DEBOUNCE_MS) {
+            toast.success(`${user.nick} зашёл в лобби`);
+            lastToastTimestamp.current.set(user.user_id, currentTime);
+          }
+        }
+      }
+    });
+
+    setOnlineUsers(newUsers);
+    setPreviousUserIds(newUserIds);
+  };
+
   const fetchOnlineUsers = async () => {
     try {
       const response = await fetch(ONLINE_API);
       if (response.ok) {
         const data = await response.json();
-        const newUsers: User[] = data.users || [];
-        
-        const newUserIds = new Set(newUsers.map(u => u.user_id));
-        const currentTime = Date.now();
-        
-        newUsers.forEach(user => {
-          if (!previousUserIds.has(user.user_id)) {
-            const currentUserId = localStorage.getItem('user_id');
-            if (user.user_id !== currentUserId) {
-              const lastShown = lastToastTimestamp.current.get(user.user_id) || 0;
-              if (currentTime - lastShown > TOAST_DEBOUNCE_MS) {
-                toast.success(`${user.nick} зашёл в лобби`);
-                lastToastTimestamp.current.set(user.user_id, currentTime);
-              }
-            }
-          }
-        });
-
-        setOnlineUsers(newUsers);
-        setPreviousUserIds(newUserIds);
+        applyOnlineUsers(data.users || []);
       }
     } catch (error) {
       console.error('Fetch online users error:', error);
@@ -114,6 +112,19 @@ export default function Lobby() {
     }
   };
 
+  const applyRoomsEvent = (data: { rooms: Room[]; full: boolean }) => {
+    if (data.full) {
+      setRooms(data.rooms);
+      return;
+    }
+    setRooms(prev => {
+      const changed = new Map(data.rooms.map(r => [r.room_id, r]));
+      const known = new Set(prev.map(r => r.room_id));
+      const added = data.rooms.filter(r => !known.has(r.room_id));
+      return [...added, ...prev.map(r => changed.get(r.room_id) ?? r)];
+    });
+  };
+
   const createRoom = async () => {
     if (!roomName || roomName.length < 1 || roomName.length > 20) {
       toast.error('Название должно быть от 1 до 20 символов');
@@ -164,13 +175,10 @@ export default function Lobby() {
     try {
       const response = await fetch(`${ROOMS_API}?action=join&room_id=${roomId}`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          user_id: localStorage.getItem('user_id'),
-          nick: localStorage.getItem('nick'),
-          avatar_url: localStorage.getItem('avatar_url'),
-          color: localStorage.getItem('color'),
-        }),
+        headers: {
+          'Content-Type': 'application/json',
+          'Authorization': `Bearer ${localStorage.getItem('token')}`,
+        },
       });
 
       if (response.ok) {
@@ -231,10 +239,23 @@ export default function Lobby() {
     runInitialFetch();
 
     heartbeatRef.current = setInterval(sendHeartbeat, HEARTBEAT_INTERVAL);
-    pollRef.current = setInterval(fetchOnlineUsers, POLL_INTERVAL);
-    roomsPollRef.current = setInterval(fetchRooms, POLL_INTERVAL);
+
+    let stream: EventSource | null = null;
+    if (STREAM_API) {
+      stream = new EventSource(`${STREAM_API}/stream?token=${encodeURIComponent(token)}`);
+      stream.addEventListener('presence', (e) => {
+        applyOnlineUsers(JSON.parse((e as MessageEvent).data).users || []);
+      });
+      stream.addEventListener('rooms', (e) => {
+        applyRoomsEvent(JSON.parse((e as MessageEvent).data));
+      });
+    } else {
+      pollRef.current = setInterval(fetchOnlineUsers, POLL_INTERVAL);
+      roomsPollRef.current = setInterval(fetchRooms, POLL_INTERVAL);
+    }
 
     return () => {
+      stream?.close();
       if (heartbeatRef.current) clearInterval(heartbeatRef.current);
       if (pollRef.current) clearInterval(pollRef.current);
       if (roomsPollRef.current) clearInterval(roomsPollRef.current);
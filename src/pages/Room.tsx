@@ -28,10 +28,29 @@ interface RoomInfo {
   current: number;
 }
 
+interface RoomSnapshot {
+  room: RoomInfo;
+  members: User[];
+  messages: Message[];
+}
+
 const ROOMS_API = 'https://functions.poehali.dev/2a2cf5ab-d01d-4975-88a1-cbb437d859dd';
 const WS_MESSAGES_API = 'https://functions.poehali.dev/7656a328-0a04-4d38-bbeb-761617c1247e';
 const POLL_INTERVAL = 3000;
-const WS_POLL_INTERVAL = 1000;
+const WS_POLL_TIMEOUT = 25;
+const WS_RETRY_DELAY = 1000;
+const STREAM_API = import.meta.env.VITE_STREAM_API as string | undefined;
+const MESSAGE_LIMIT = 30;
+
+// A message can commit after one with a higher id, so merges are re-sorted before the oldest are dropped
+const mergeMessages = (current: Message[], incoming: Message[]): Message[] => {
+  const known = new Set(current.map(m => m.id));
+  const fresh = incoming.filter(m => !known.has(m.id));
+  if (fresh.length === 0) return current;
+  return [...current, ...fresh]
+    .sort((a, b) => a.id - b.id)
+    .slice(-MESSAGE_LIMIT);
+};
 
 export default function Room() {
   const { roomId } = useParams<{ roomId: string }>();
@@ -48,8 +67,10 @@ export default function Room() {
   const messagesContainerRef = useRef<HTMLDivElement>(null);
   const pollMembersRef = useRef<NodeJS.Timeout | null>(null);
   const pollMessagesRef = useRef<NodeJS.Timeout | null>(null);
-  const pollWsRef = useRef<NodeJS.Timeout | null>(null);
+  const wsAbortRef = useRef<AbortController | null>(null);
   const lastWsTimestampRef = useRef<number>(0);
+  const lastWsCursorRef = useRef<number | null>(null);
+  const lastMessageIdRef = useRef<number | null>(null);
   const currentUserId = localStorage.getItem('user_id');
 
   const scrollToBottom = () => {
@@ -66,15 +87,29 @@ export default function Room() {
     }
   };
 
-  const fetchRoomInfo = async () => {
+  // Room, members and the latest messages in one request when entering the room
+  const fetchSnapshot = async () => {
+    const token = localStorage.getItem('token');
+    if (!token) return;
+
     try {
-      const response = await fetch(`${ROOMS_API}?room_id=${roomId}`);
+      const response = await fetch(`${ROOMS_API}?action=snapshot&room_id=${roomId}&limit=30`, {
+        headers: {
+          'Authorization': `Bearer ${token}`
+        }
+      });
       if (response.ok) {
-        const data: RoomInfo = await response.json();
-        setRoom(data);
+        const data: RoomSnapshot = await response.json();
+        setRoom(data.room);
+        setMembers(data.members);
+        if (data.messages.length > 0) {
+          const lastId = data.messages[data.messages.length - 1].id;
+          lastMessageIdRef.current = Math.max(lastMessageIdRef.current ?? 0, lastId);
+        }
+        setMessages(prev => mergeMessages(prev, data.messages));
       }
     } catch (error) {
-      console.error('Fetch room info error:', error);
+      console.error('Fetch snapshot error:', error);
     }
   };
 
@@ -101,29 +136,43 @@ export default function Room() {
     const token = localStorage.getItem('token');
     if (!token) return;
 
+    const afterId = lastMessageIdRef.current;
+    const cursor = afterId !== null ? `&after_id=${afterId}` : '';
+
     try {
-      const response = await fetch(`${ROOMS_API}?action=messages&room_id=${roomId}&limit=30`, {
+      const response = await fetch(`${ROOMS_API}?action=messages&room_id=${roomId}&limit=30${cursor}`, {
         headers: {
           'Authorization': `Bearer ${token}`
         }
       });
       if (response.ok) {
         const data: Message[] = await response.json();
-        setMessages(data.slice(-30));
+        if (data.length > 0) {
+          lastMessageIdRef.current = Math.max(afterId ?? 0, ...data.map(m => m.id));
+        }
+        if (afterId === null) {
+          setMessages(mergeMessages([], data));
+        } else if (data.length > 0) {
+          setMessages(prev => mergeMessages(prev, data));
+        }
       }
     } catch (error) {
       console.error('Fetch messages error:', error);
     }
   };
 
-  const pollNewMessages = async () => {
-    if (!roomId) return;
+  const pollNewMessages = async (signal: AbortSignal): Promise<boolean> => {
+    if (!roomId) return false;
     const token = localStorage.getItem('token');
-    if (!token) return;
+    if (!token) return false;
 
     try {
+      const position = lastWsCursorRef.current !== null
+        ? `cursor=${lastWsCursorRef.current}`
+        : `since=${lastWsTimestampRef.current}`;
       const response = await fetch(
-        `${WS_MESSAGES_API}?token=${token}&room_id=${roomId}&since=${lastWsTimestampRef.current}`
+        `${WS_MESSAGES_API}?token=${token}&room_id=${roomId}&${position}&timeout=${WS_POLL_TIMEOUT}`,
+        { signal }
       );
       if (response.ok) {
         const data = await response.json();
@@ -131,27 +180,37 @@ export default function Room() {
         if (data.timestamp) {
           lastWsTimestampRef.current = data.timestamp;
         }
+        if (typeof data.cursor === 'number') {
+          lastWsCursorRef.current = data.cursor;
+        }
 
         if (data.messages && data.messages.length > 0) {
           data.messages.forEach((event: any) => {
             if (event.type === 'message_new' && event.message) {
               const newMessage: Message = event.message;
               
-              setMessages(prev => {
-                const exists = prev.some(m => m.id === newMessage.id);
-                if (exists) return prev;
-                const updated = [...prev, newMessage];
-                return updated.slice(-30);
-              });
+              setMessages(prev => mergeMessages(prev, [newMessage]));
 
               setTimeout(scrollToBottom, 100);
             }
           });
         }
+        return true;
       }
     } catch (error) {
+      if (signal.aborted) return false;
       console.error('Poll new messages error:', error);
     }
+    return false;
+  };
+
+  const runWsLoop = async (controller: AbortController) => {
+    while (!controller.signal.aborted) {
+      const ok = await pollNewMessages(controller.signal);
+      if (!ok && !controller.signal.aborted) {
+        await new Promise(resolve => setTimeout(resolve, WS_RETRY_DELAY));
+      }
+    }
   };
 
 
@@ -176,25 +235,14 @@ export default function Room() {
           'Content-Type': 'application/json',
           'Authorization': `Bearer ${token}`
         },
-        body: JSON.stringify({
-          text,
-          user_id: localStorage.getItem('user_id'),
-          nick: localStorage.getItem('nick'),
-          avatar_url: localStorage.getItem('avatar_url'),
-          color: localStorage.getItem('color'),
-        }),
+        body: JSON.stringify({ text }),
       });
 
       if (response.ok) {
         const data = await response.json();
         const newMessage: Message = data.message;
         
-        setMessages(prev => {
-          const exists = prev.some(m => m.id === newMessage.id);
-          if (exists) return prev;
-          const updated = [...prev, newMessage];
-          return updated.slice(-30);
-        });
+        setMessages(prev => mergeMessages(prev, [newMessage]));
 
         setMessageText('');
         setTimeout(scrollToBottom, 100);
@@ -202,6 +250,7 @@ export default function Room() {
         const error = await response.json();
         if (error.error === 'empty') toast.error('Сообщение не может быть пустым');
         else if (error.error === 'too_long') toast.error('Сообщение слишком длинное');
+        else if (error.error === 'rate_limited') toast.error(`Слишком часто, подождите ${response.headers.get('Retry-After') || 1} с`);
         else toast.error('Ошибка отправки');
       }
     } catch (error) {
@@ -222,7 +271,6 @@ export default function Room() {
           'Content-Type': 'application/json',
           'Authorization': `Bearer ${token}`
         },
-        body: JSON.stringify({ user_id: localStorage.getItem('user_id') }),
       });
 
       if (response.ok) {
@@ -256,20 +304,42 @@ export default function Room() {
       return;
     }
 
-    fetchRoomInfo();
-    fetchMembers();
-    fetchMessages();
-
     lastWsTimestampRef.current = Date.now() / 1000;
+    lastWsCursorRef.current = null;
+    lastMessageIdRef.current = null;
 
-    pollMembersRef.current = setInterval(fetchMembers, POLL_INTERVAL);
-    pollMessagesRef.current = setInterval(fetchMessages, POLL_INTERVAL);
-    pollWsRef.current = setInterval(pollNewMessages, WS_POLL_INTERVAL);
+    fetchSnapshot();
+
+    let stream: EventSource | null = null;
+    if (STREAM_API) {
+      // One connection carries messages, members and this room's counter
+      stream = new EventSource(
+        `${STREAM_API}/stream?token=${encodeURIComponent(token)}&room_id=${encodeURIComponent(roomId ?? '')}`
+      );
+      stream.addEventListener('messages', (e) => {
+        const incoming: Message[] = JSON.parse((e as MessageEvent).data);
+        setMessages(prev => mergeMessages(prev, incoming));
+      });
+      stream.addEventListener('members', (e) => {
+        setMembers(JSON.parse((e as MessageEvent).data));
+      });
+      stream.addEventListener('rooms', (e) => {
+        const data: { rooms: RoomInfo[] } = JSON.parse((e as MessageEvent).data);
+        const updated = data.rooms.find(r => r.room_id === roomId);
+        if (updated) setRoom(updated);
+      });
+    } else {
+      pollMembersRef.current = setInterval(fetchMembers, POLL_INTERVAL);
+      pollMessagesRef.current = setInterval(fetchMessages, POLL_INTERVAL);
+      wsAbortRef.current = new AbortController();
+      runWsLoop(wsAbortRef.current);
+    }
 
     return () => {
+      stream?.close();
       if (pollMembersRef.current) clearInterval(pollMembersRef.current);
       if (pollMessagesRef.current) clearInterval(pollMessagesRef.current);
-      if (pollWsRef.current) clearInterval(pollWsRef.current);
+      wsAbortRef.current?.abort();
     };
   }, [roomId, navigate]);
 